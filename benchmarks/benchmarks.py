@@ -0,0 +1,221 @@
+"""
+Benchmarks of the exporters, loaders and plotting helpers, to be run with asv:
+
+    asv run
+    asv compare HEAD~1 HEAD
+
+The figures are synthetic and parameterized by the number of axes, lines, points and labels.
+"""
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+
+from tudplot import sequential_colors
+from tudplot.xmgrace import export_to_agr, load_agr_data, AgrDocument
+from tudplot.tex2grace import latex_to_xmgrace, LatexTranslator
+from tudplot.utils import facet_plot, CurvedText
+from pygrace import pygrace
+from pygrace.str2format import str2format, translate_labels
+
+LABELS = [r'$\alpha_{%d}$', r'$T_{1,%d}$ / K', r'$\tau_\mathrm{c}^{%d}$', 'line %d', r'$\omega\,t_%d$']
+
+
+def make_labels(n):
+    return [LABELS[i % len(LABELS)] % i for i in range(n)]
+
+
+def make_figure(naxes, nlines, npoints, ntexts=0):
+    """
+    Create a figure with naxes axes, each with nlines lines of npoints points and ntexts texts.
+    """
+    fig, axes = plt.subplots(naxes, 1, squeeze=False)
+    x = np.linspace(0.1, 10, npoints)
+    labels = make_labels(nlines)
+    for ax in axes.ravel():
+        for i, label in enumerate(labels):
+            ax.plot(x, np.sin(x + i), '-o', label=label)
+        for i in range(ntexts):
+            ax.text(1, i / max(ntexts, 1), r'$\beta_{%d}$' % i)
+        ax.set_xlabel(r'$\tau$ / s')
+        ax.set_ylabel(r'$\mathrm{d}x$')
+        ax.legend()
+    fig.canvas.draw()
+    return fig
+
+
+class ExportAgr:
+    params = ([1, 4], [1, 20, 100], [100, 100000])
+    param_names = ['axes', 'lines', 'points']
+    timeout = 300
+
+    def setup(self, naxes, nlines, npoints):
+        if nlines * npoints > 2 * 10**6:
+            raise NotImplementedError()
+        self.fig = make_figure(naxes, nlines, npoints, ntexts=5)
+        self.tmpdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmpdir, 'bench.agr')
+
+    def teardown(self, naxes, nlines, npoints):
+        plt.close(self.fig)
+        shutil.rmtree(self.tmpdir)
+
+    def time_export_to_agr(self, naxes, nlines, npoints):
+        export_to_agr(self.fig, self.filename)
+
+    def peakmem_export_to_agr(self, naxes, nlines, npoints):
+        export_to_agr(self.fig, self.filename)
+
+    def time_export_to_agr_downsample(self, naxes, nlines, npoints):
+        export_to_agr(self.fig, self.filename, precision='auto', downsample='minmax')
+
+    def time_pygrace_saveagr(self, naxes, nlines, npoints):
+        pygrace.saveagr(self.filename, self.fig)
+
+    def peakmem_pygrace_saveagr(self, naxes, nlines, npoints):
+        pygrace.saveagr(self.filename, self.fig)
+
+
+class AgrDocumentExport:
+    params = ([1, 20, 100], [100, 100000])
+    param_names = ['sets', 'points']
+    timeout = 300
+
+    def setup(self, nsets, npoints):
+        if nsets * npoints > 2 * 10**6:
+            raise NotImplementedError()
+        self.x = np.linspace(0.1, 10, npoints)
+        self.labels = make_labels(nsets)
+        self.tmpdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmpdir, 'bench.agr')
+
+    def teardown(self, nsets, npoints):
+        shutil.rmtree(self.tmpdir)
+
+    def time_agr_document(self, nsets, npoints):
+        doc = AgrDocument()
+        graph = doc.graph(xlabel=r'$\tau$ / s', legend=True)
+        for i, label in enumerate(self.labels):
+            graph.set(self.x, np.sin(self.x + i), label=label, marker='o')
+        doc.save(self.filename)
+
+
+class LoadAgr:
+    params = ([1, 20, 100], [100, 100000])
+    param_names = ['sets', 'points']
+    timeout = 300
+
+    def setup(self, nsets, npoints):
+        if nsets * npoints > 2 * 10**6:
+            raise NotImplementedError()
+        fig = make_figure(1, nsets, npoints)
+        self.tmpdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmpdir, 'bench.agr')
+        export_to_agr(fig, self.filename)
+        plt.close(fig)
+
+    def teardown(self, nsets, npoints):
+        shutil.rmtree(self.tmpdir)
+
+    def time_load_agr_data(self, nsets, npoints):
+        load_agr_data(self.filename)
+
+    def peakmem_load_agr_data(self, nsets, npoints):
+        load_agr_data(self.filename)
+
+    def time_load_agr_data_frame(self, nsets, npoints):
+        load_agr_data(self.filename, as_frame=True)
+
+
+class Labels:
+    params = [10, 10000]
+    param_names = ['labels']
+
+    def setup(self, nlabels):
+        self.labels = make_labels(nlabels)
+        self.uncached = LatexTranslator(cache_size=0)
+        self.plain = [label.replace('$', '').replace('\\', '') for label in self.labels]
+
+    def time_latex_to_xmgrace(self, nlabels):
+        for label in self.labels:
+            latex_to_xmgrace(label)
+
+    def time_latex_to_xmgrace_uncached(self, nlabels):
+        for label in self.labels:
+            self.uncached(label)
+
+    def time_str2format(self, nlabels):
+        for label in self.plain:
+            str2format(label)
+
+    def time_str2format_uncached(self, nlabels):
+        for label in self.plain:
+            str2format.__wrapped__(label)
+
+    def time_translate_labels(self, nlabels):
+        translate_labels(self.plain)
+
+    def peakmem_latex_to_xmgrace_uncached(self, nlabels):
+        for label in self.labels:
+            self.uncached(label)
+
+    def peakmem_translate_labels(self, nlabels):
+        translate_labels(self.plain)
+
+
+class FacetPlot:
+    params = ([4, 16], [3, 10])
+    param_names = ['facets', 'props']
+    timeout = 300
+
+    def setup(self, nfacets, nprops):
+        import pandas
+        x = np.linspace(0, 1, 100)
+        self.frame = pandas.concat([
+            pandas.DataFrame({'facet': f, 'prop': p, 'y': np.sin(x * (f + p))}, index=x)
+            for f in range(nfacets) for p in range(nprops)
+        ])
+
+    def teardown(self, nfacets, nprops):
+        plt.close('all')
+
+    def time_facet_plot(self, nfacets, nprops):
+        facet_plot(self.frame, 'facet', 'prop', 'y')
+
+    def peakmem_facet_plot(self, nfacets, nprops):
+        facet_plot(self.frame, 'facet', 'prop', 'y')
+
+
+class CurvedTextDraw:
+    params = [10, 100]
+    param_names = ['chars']
+
+    def setup(self, nchars):
+        self.fig, ax = plt.subplots()
+        x = np.linspace(0, 10, 1000)
+        ax.plot(x, np.sin(x))
+        CurvedText(x, np.sin(x), ('curved text ' * nchars)[:nchars], ax)
+
+    def teardown(self, nchars):
+        plt.close(self.fig)
+
+    def time_draw(self, nchars):
+        self.fig.canvas.draw()
+
+    def peakmem_draw(self, nchars):
+        self.fig.canvas.draw()
+
+
+class SequentialColors:
+    params = ([10, 1000], ['blue-red', 'viridis'])
+    param_names = ['N', 'cmap']
+
+    def time_sequential_colors(self, N, cmap):
+        sequential_colors(N, cmap=cmap)
+
+    def peakmem_sequential_colors(self, N, cmap):
+        sequential_colors(N, cmap=cmap)
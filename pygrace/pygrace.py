@@ -1,12 +1,14 @@
 import numpy as np
 from matplotlib.colors import ColorConverter
-from matplotlib.backends import backend_agg
 import matplotlib.pyplot as plt
-import textwrap
+from io import StringIO
 from itertools import zip_longest
 from collections import defaultdict
 
-from . import tex2grace
+from tudplot.xmgrace import (format_data, auto_precision, open_agr, ColorRegistry, figure_colors,
+                             decimate, decimation_params, Layout, get_stats,
+                             get_fillstyle, has_markers)
+
 from .tex2grace import latex_to_xmgrace
 
 
@@ -31,7 +33,29 @@ def get_world_coords(artist):
     return trans.transform(artist.get_window_extent())
 
 
-class AgrText:
+class AgrRecord:
+    """
+    Base class of the records of an agr file.
+
+    The attributes of a record are kept in its slots, which are filled in an explicit order
+    when the record is created. The record is written by formatting `fmt` with these attributes.
+    """
+    __slots__ = ()
+    fmt = ''
+
+    def __getitem__(self, key):
+        return getattr(self, key)
+
+    def write(self, file, prefix=''):
+        for line in self.fmt.format_map(self).splitlines(True):
+            file.write(prefix + line if line.strip() else line)
+
+    def __str__(self):
+        return self.fmt.format_map(self)
+
+
+class AgrText(AgrRecord):
+    __slots__ = ('text', 'agr_axis', 'agr_figure', 'value', 'size', 'color', 'position')
     fmt = """string on
 string loctype view
 string {position}
@@ -41,8 +65,8 @@ string def "{value}"
 """
 
     def get_position(self):
-        trans = self.agr_axis.agr_figure.figure.transFigure.inverted()
-        pos = trans.transform(self.text.get_window_extent())[0]
+        layout = self.agr_figure.layout
+        pos = layout.figure_inverted.transform(layout.window_extent(self.text))[0]
         pos = (pos + self.agr_figure.offset) * self.agr_figure.pagescale
         self.position = '{:.5f}, {:.5f}'.format(*pos)
 
@@ -51,17 +75,16 @@ string def "{value}"
         self.agr_axis = agr_axis
         self.agr_figure = agr_axis.agr_figure
 
-        self.value = latex_to_xmgrace(text.get_text())
+        self.value = self.agr_figure.latex(text.get_text())
         self.size = text.get_fontsize() * self.agr_figure.fontscale
-        self.color = AgrLine.color_index(text.get_color())
+        self.color = self.agr_figure.colors.index(text.get_color())
         self.get_position()
-        sanitize_strings(self.__dict__)
 
-    def __str__(self):
-        return self.fmt.format(**self.__dict__)
 
-
-class AgrLine:
+class AgrLine(AgrRecord):
+    __slots__ = ('agr_axis', 'agr_figure', 'line', 'hidden', 'type', 'label', 'linestyle',
+                 'linewidth', 'color', 'marker', 'markerfacecolor', 'markeredgecolor',
+                 'markeredgewidth', 'markerfill')
     fmt = """hidden {hidden}
 type {type}
 legend "{label}"
@@ -82,24 +105,29 @@ symbol linewidth {linewidth}
         {'': 0, 'None': 0, 'o': 1, 's': 2, 'd': 3, '^': 4, '<': 5, 'v': 6, '>': 7, '+': 8, 'x': 9, '*': 10}
     )
     fillstyles = ('none', 'full', 'right', 'left', 'bottom', 'top')
-    colors = ['white', 'black']
-
-    def color_index(col):
-        if col not in AgrLine.colors:
-            AgrLine.colors.append(col)
-        return AgrLine.colors.index(col)
+    colors = ('white', 'black')
 
     @property
     def data(self):
-        o = '@type xy\n'
-        for x, y in self.line.get_xydata():
-            o += '{} {}\n'.format(x, y)
-        o += '&'
-        return o
+        return '@type xy\n' + ''.join(self.data_chunks()) + '&'
+
+    def data_chunks(self):
+        """
+        Get the data of the line as chunks of formatted lines.
+        """
+        xy = self.line.get_xydata()
+        pagesize = self.agr_figure.figure.get_size_inches() * self.agr_figure.dpi
+        precision = self.agr_figure.precision
+        if precision == 'auto':
+            precision = auto_precision(xy, self.agr_axis.axis, pagesize)
+        if self.agr_figure.downsample is not None and not has_markers(self.line):
+            xy = decimate(xy, **decimation_params(self.agr_axis.axis, pagesize,
+                                                  self.agr_figure.downsample))
+        return format_data(xy, precision=precision, finite=False)
 
     def get_label(self):
         lbl = self.line.get_label()
-        self.label = latex_to_xmgrace(lbl) if not lbl.startswith('_line') else ''
+        self.label = self.agr_figure.latex(lbl) if not lbl.startswith('_line') else ''
 
     def get_linestyle(self):
         self.linestyle = self.linestyles[self.line.get_linestyle()]
@@ -108,36 +136,38 @@ symbol linewidth {linewidth}
         self.linewidth = self.line.get_linewidth() * self.width_scale
 
     def get_color(self):
-        self.color = AgrLine.color_index(self.line.get_color())
+        self.color = self.agr_figure.colors.index(self.line.get_color())
 
     def get_marker(self):
         mk = self.line.get_marker()
         self.marker = self.markers[mk] if mk in self.markers else 1
         mfc = self.line.get_markerfacecolor()
-        self.markerfacecolor = AgrLine.color_index(mfc)
+        self.markerfacecolor = self.agr_figure.colors.index(mfc)
         mec = self.line.get_markeredgecolor()
-        self.markeredgecolor = AgrLine.color_index(mec)
+        self.markeredgecolor = self.agr_figure.colors.index(mec)
         self.markeredgewidth = self.line.get_markeredgewidth() * self.width_scale
-        self.markerfill = self.fillstyles.index(self.line.get_fillstyle())
+        self.markerfill = self.fillstyles.index(get_fillstyle(self.line))
 
     def __init__(self, line, agr_axis):
         self.agr_axis = agr_axis
+        self.agr_figure = agr_axis.agr_figure
         self.line = line
         self.hidden = 'false'
         self.type = 'xy'
 
-        # run all get_ methods
-        for d in dir(self):
-            if d.startswith('get_'):
-                getattr(self, d)()
+        # the order determines the indices of new colors
+        self.get_color()
+        self.get_label()
+        self.get_linestyle()
+        self.get_linewidth()
+        self.get_marker()
 
-        sanitize_strings(self.__dict__)
 
-    def __str__(self):
-        return self.fmt.format(**self.__dict__)
-
-
-class AgrAxis:
+class AgrAxis(AgrRecord):
+    __slots__ = ('agr_figure', 'axis', 'world', 'view', 'title', 'xlabel', 'xlabelpos', 'ylabel',
+                 'ylabelpos', 'xscale', 'xticks', 'xticklabel', 'xticklabelpos', 'yticklabel',
+                 'yticklabelpos', 'yscale', 'yticks', 'labelsize', 'ticklabelsize', 'legend',
+                 'legend_pos', 'legend_fontsize', 'lines', 'texts')
     fmt = """world {world}
 view {view}
 title {title}
@@ -177,14 +207,14 @@ legend char size {legend_fontsize}
         )
 
     def get_title(self):
-        self.title = latex_to_xmgrace(self.axis.get_title())
+        self.title = self.agr_figure.latex(self.axis.get_title())
 
     def get_xyaxis(self):
-        self.xlabel = latex_to_xmgrace(self.axis.get_xlabel())
+        self.xlabel = self.agr_figure.latex(self.axis.get_xlabel())
         xpos = self.axis.xaxis.get_label_position()
         self.xlabelpos = 'normal' if xpos == 'bottom' else 'opposite'
 
-        self.ylabel = latex_to_xmgrace(self.axis.get_ylabel())
+        self.ylabel = self.agr_figure.latex(self.axis.get_ylabel())
         ypos = self.axis.yaxis.get_label_position()
         self.ylabelpos = 'normal' if ypos == 'left' else 'opposite'
 
@@ -249,7 +279,7 @@ legend char size {legend_fontsize}
             self.legend = 'on'
             for lbl, line in zip(leg.get_texts(), leg.get_lines()):
                 pass
-            pos = get_world_coords(leg)
+            pos = self.agr_figure.layout.world_coords(leg)
             self.legend_pos = '{:.3f}, {:.3f}'.format(*pos.diagonal())
             self.legend_fontsize = leg.get_texts()[0].get_fontsize() * self.agr_figure.fontscale
 
@@ -257,23 +287,26 @@ legend char size {legend_fontsize}
         self.agr_figure = agr_fig
         self.axis = axis
 
-        # run all get_ methods
-        for d in dir(self):
-            if d.startswith('get_'):
-                getattr(self, d)()
+        self.get_legend()
+        self.get_title()
+        self.get_world()
+        self.get_xyaxis()
 
-        sanitize_strings(self.__dict__)
         self.lines = {'s{}'.format(i): AgrLine(l, self) for i, l in enumerate(axis.lines)}
         self.texts = [AgrText(t, self) for t in self.axis.texts]
 
-    def __str__(self):
-        o = self.fmt.format(**self.__dict__)
+    def write(self, file, prefix=''):
+        super().write(file, prefix)
         for k, l in self.lines.items():
-            o += textwrap.indent(str(l), prefix=k + ' ')
+            l.write(file, prefix + k + ' ')
         for txt in self.texts:
-            o += 'with string\n'
-            o += textwrap.indent(str(txt), prefix='    ')
-        return o
+            file.write(prefix + 'with string\n')
+            txt.write(file, prefix + '    ')
+
+    def __str__(self):
+        buffer = StringIO()
+        self.write(buffer)
+        return buffer.getvalue()
 
 
 class AgrFigure:
@@ -300,56 +333,103 @@ class AgrFigure:
 
         self.pagescale = np.array([fx, fy]) / min(fx * scx, fy * scy)
 
-    def __init__(self, figure, offset_horizontal=0, offset_vertical=0, convert_latex=True):
-        tex2grace.do_latex_conversion = convert_latex
+    def __init__(self, figure, offset_horizontal=0, offset_vertical=0, convert_latex=True,
+                 precision=None, palette=None, downsample=None, layout=None, profile=None):
+        self.stats = get_stats(profile)
+        self.convert_latex = convert_latex
         self.figure = figure
+        self.precision = precision
+        self.downsample = downsample
+        self.colors = ColorRegistry(AgrLine.colors)
+        if palette is not None:
+            colors = figure_colors(figure) + [t.get_color() for ax in figure.axes for t in ax.texts]
+            self.colors.set_palette(palette, colors)
         self.offset = np.array([offset_horizontal, offset_vertical])
-        # make sure to draw the figure...
-        canv = backend_agg.FigureCanvasAgg(figure)
-        canv.draw()
-
-        # run all get_ methods
-        for d in dir(self):
-            if d.startswith('get_'):
-                getattr(self, d)()
-        sanitize_strings(self.__dict__)
+        # the layout of the figure, computed without rasterizing the lines
+        with self.stats.phase('layout'):
+            self.layout = layout or Layout(figure)
+
+        self.get_figprops()
+        with self.stats.phase('attributes'):
+            self.axes = {'g{}'.format(i): AgrAxis(ax, self) for i, ax in enumerate(self.figure.axes)}
+
+    def latex(self, string):
+        with self.stats.phase('latex'):
+            return latex_to_xmgrace(string, self.convert_latex)
+
+    def write(self, file):
+        """
+        Write the agr file to an open file or buffer.
+
+        The data of the lines is formatted chunk-wise while it is written, hence the
+        document is never held in memory as a whole.
+        """
+        stats = self.stats
+        with stats.phase('write'):
+            file.write(self.fmt.format(page=self.page))
+
+            for i, col, rgba in self.colors:
+                rgb = [int(x * 255) for x in rgba[:3]]
+                file.write('@map color {i} to ({rgb[0]}, {rgb[1]}, {rgb[2]}), "{col}"\n'.format(i=i, rgb=rgb, col=col))
+
+            for k, ax in self.axes.items():
+                for line in ('on', 'hidden false', 'type XY', 'stacked false'):
+                    file.write('@{} {}\n'.format(k, line))
+                file.write('@with {}\n'.format(k))
+                ax.write(file, prefix='@    ')
 
-        self.axes = {'g{}'.format(i): AgrAxis(ax, self) for i, ax in enumerate(self.figure.axes)}
+        for ia, ax in self.axes.items():
+            for il, ln in ax.lines.items():
+                stats.count('sets')
+                stats.count('points', len(ln.line.get_xydata()))
+                file.write('@target {}.{}\n@type xy\n'.format(ia.upper(), il.upper()))
+                chunks = ln.data_chunks()
+                while True:
+                    with stats.phase('format'):
+                        chunk = next(chunks, None)
+                    if chunk is None:
+                        break
+                    with stats.phase('write'):
+                        file.write(chunk)
+                    stats.count('bytes', len(chunk))
+                file.write('&\n')
 
     def __str__(self):
-        o = self.fmt.format(**self.__dict__)
-
-        for i, col in enumerate(AgrLine.colors):
-            # in matplotlib-1.5 to_rgb can not handle 'none', this was fixed in 2.0
-            rgb = [int(x * 255) for x in AgrLine.cc.to_rgba(col)[:3]]
-            o += '@map color {i} to ({rgb[0]}, {rgb[1]}, {rgb[2]}), "{col}"\n'.format(i=i, rgb=rgb, col=col)
-
-        for k, ax in self.axes.items():
-            o += textwrap.indent("on\nhidden false\ntype XY\nstacked false\n", prefix='@{} '.format(k))
-            o += '@with {}\n'.format(k)
-            o += textwrap.indent(str(ax), prefix='@    ')
-
-        for k, d in self.collect_data().items():
-            o += self.data_fmt.format(target=k, data=d)
-
-        return o
+        buffer = StringIO()
+        self.write(buffer)
+        return buffer.getvalue()
 
 
-def saveagr(fname, figure=None, offset_x=0, offset_y=0, convert_latex=True):
+def saveagr(fname, figure=None, offset_x=0, offset_y=0, convert_latex=True, precision=None,
+            palette=None, downsample=None, profile=None):
     """
     Save figure as xmgrace plot.
 
     If no figure is provided, this will save the current figure.
 
     Args:
-        fname: Filename of the agr plot
+        fname: Filename of the agr plot, compressed if it ends with .gz, .bz2 or .xz
         figure (opt.): Matplotlib figure to save, if None gcf() is used.
         offset_x, offset_y (opt.): Add an offest in x or y direction to the xmgrace plot.
         convert_latex (opt.): If latex strings will be converted to xmgrace.
+        precision (opt.):
+            Number of significant digits of the data, or 'auto' to choose it from
+            the resolution of the plot. By default the full precision is written.
+        palette (opt.):
+            Restrict the colors to a palette, 'tud' for the nearest TU colors or a
+            number N to reduce the colors of the figure to N colors.
+        downsample (opt.):
+            Reduce the points of large lines to the resolution of the plot,
+            either with 'minmax' or 'lttb'.
+        profile (opt.):
+            An ExportStats or a callback, to profile the phases of the export,
+            see `tudplot.xmgrace.ExportStats`.
     """
     if figure is None:
         figure = plt.gcf()
-    with open(fname, 'w') as f:
+    with open_agr(fname, 'w') as f:
         af = AgrFigure(figure, offset_horizontal=offset_x, offset_vertical=offset_y,
-                       convert_latex=convert_latex)
-        f.write(str(af))
+                       convert_latex=convert_latex, precision=precision, palette=palette,
+                       downsample=downsample, profile=profile)
+        af.write(f)
+    af.stats.finish()
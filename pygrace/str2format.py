@@ -1,6 +1,9 @@
 from __future__ import print_function
+from functools import lru_cache
 import re
 
+import numpy as np
+
 small_greek = {'alpha': u'\u03b1',
                'beta': u'\u03b2',
                'gamma': u'\u03b3',
@@ -128,69 +131,113 @@ for d in [big_greek, small_greek, special_chars]:
 full_char_reverse = {y: x for x, y in full_chars.items()}
 
 
-def _replace_unicode(text):
-    for k, v in full_chars.items():
-        text = text.replace(k, v)
-    return text
+_untags = {u'<sub>': '_{', u'</sub>': '}', u'<sup>': '^{', u'</sup>': '}'}
+
+grace_chars = {'_{': r'\s', '^{': r'\S', '}': r'\N'}
+for d in [big_greek_grace, small_greek_grace, special_chars_grace]:
+    grace_chars.update(d)
+
+_grace_untags = {r'\s': '_{', r'\S': '^{', r'\N': '}', r'\f{}': ''}
+
+
+def _alternation(keys):
+    """Build a regex that matches any of the keys, longest keys first."""
+    return '|'.join(re.escape(k) for k in sorted(keys, key=len, reverse=True))
+
 
+_sub_pattern = re.compile(r'_(?:\{(\S*?)\}|(\S))')
+_format_pattern = re.compile(r'\^(?:\{(\S*?)\}|(\S))|' + _alternation(full_chars))
+_unformat_pattern = re.compile(_alternation(list(full_char_reverse) + list(_untags)))
+_grace_pattern = re.compile(_alternation(grace_chars))
+_ungrace_pattern = re.compile(_alternation(_grace_untags))
 
-def _replacesub(text):
-    sub_pattern_1 = re.compile('(_\{\S*?\})')
-    sub_pattern_2 = re.compile('_\S')
-    for s in sub_pattern_1.findall(text):
-        text = text.replace(s, u'<sub>{0:}</sub>'.format(s[2:-1]))
-    for s in sub_pattern_2.findall(text):
-        text = text.replace(s, u'<sub>{0:}</sub>'.format(s[1:]))
-    return text
 
+def _sub_match(match):
+    content = match.group(1) if match.group(1) is not None else match.group(2)
+    return u'<sub>' + _sub_pattern.sub(_sub_match, content) + u'</sub>'
 
-def _replacesup(text):
-    sup_pattern_1 = re.compile('\^\{\S*?\}')
-    sup_pattern_2 = re.compile('\^\S')
-    for s in sup_pattern_1.findall(text):
-        text = text.replace(s, u'<sup>{0:}</sup>'.format(s.strip()[2:-1]))
-    for s in sup_pattern_2.findall(text):
-        text = text.replace(s, u'<sup>{0:}</sup>'.format(s.strip()[1:]))
-    return text
 
+def _format_match(match):
+    text = match.group(0)
+    if text[0] != '^':
+        return full_chars[text]
+    content = match.group(1) if match.group(1) is not None else match.group(2)
+    return u'<sup>' + _format_pattern.sub(_format_match, content) + u'</sup>'
 
+
+def _unformat_match(match):
+    text = match.group(0)
+    return _untags[text] if text in _untags else full_char_reverse[text]
+
+
+@lru_cache(maxsize=4096)
 def str2format(text):
-    text = _replacesub(text)
-    text = _replacesup(text)
-    text = _replace_unicode(text)
+    """
+    Convert a string like 'T_{1}^alpha' to a formatted string with html tags for sub- and
+    superscripts and unicode characters for greek letters.
 
-    return text
+    Subscripts are converted in a first scan, superscripts and characters in a second one.
+    """
+    return _format_pattern.sub(_format_match, _sub_pattern.sub(_sub_match, text))
 
 
+@lru_cache(maxsize=4096)
 def format2str(text):
-    for k, v in full_char_reverse.items():
-        text = text.replace(k, v)
-    for k, v in [('<sub>', '_{'), ('</sub>', '}'), ('<sup>', '^{'), ('</sup>', '}')]:
-        text = text.replace(k, v)
-
-    return text
+    """Convert a formatted string back to its plain version, see `str2format`."""
+    return _unformat_pattern.sub(_unformat_match, text)
 
 
+@lru_cache(maxsize=4096)
 def format2grace(text):
-    text = format2str(text)
-    for k, v in [('_{', r'\s'), ('}', r'\N'), ('^{', r'\S'), ('}', r'\N')]:
-        text = text.replace(k, v)
-    for k, v in big_greek_grace.items():
-        text = text.replace(k, v)
-    for k, v in small_greek_grace.items():
-        text = text.replace(k, v)
-    for k, v in special_chars_grace.items():
-        text = text.replace(k, v)
-
-    return text
+    """Convert a formatted string to xmgrace format."""
+    return _grace_pattern.sub(lambda m: grace_chars[m.group(0)], format2str(text))
 
 
+@lru_cache(maxsize=4096)
 def grace2str(text):
-    text = text.replace(r'\s', '_{').replace('\S', '^{')
-    text = text.replace(r'\N', '}')
-    text = text.replace(r'\f{}', '')
-
-    return text
+    """Convert a string in xmgrace format to its plain version."""
+    return _ungrace_pattern.sub(lambda m: _grace_untags[m.group(0)], text)
+
+
+translators = {
+    'str2format': str2format,
+    'format2str': format2str,
+    'format2grace': format2grace,
+    'grace2str': grace2str,
+}
+
+
+def translate_labels(labels, how='str2format'):
+    """
+    Convert many labels at once.
+
+    Each distinct label is converted only once, which is much faster for tables
+    where the same labels are repeated.
+
+    Args:
+        labels:
+            A list, array or pandas Series of strings, entries that are not strings
+            (e.g. None or NaN for missing labels) are passed through unchanged.
+        how (opt.): The conversion, one of the keys of `translators`
+    Returns:
+        An object array of the converted labels, or a Series with the same index
+        if labels is a Series.
+    """
+    convert = translators[how]
+    values = np.asarray(labels, dtype=object)
+    converted = {}
+    result = np.empty(values.shape, dtype=object)
+    flat = result.reshape(-1)
+    for i, value in enumerate(values.flat):
+        if isinstance(value, str):
+            if value not in converted:
+                converted[value] = convert(value)
+            value = converted[value]
+        flat[i] = value
+    if hasattr(labels, 'index') and hasattr(labels, 'name'):
+        import pandas
+        return pandas.Series(result, index=labels.index, name=labels.name)
+    return result
 
 if __name__ == '__main__':
     stringtext = 'M_{infty}[1-alpha exp(-x/T_{1,1})^{beta_1}]'
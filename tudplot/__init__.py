@@ -1,11 +1,20 @@
 import os
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, Future
 
 import numpy
 import matplotlib as mpl
 from matplotlib import pyplot
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.colors import to_rgba
+import matplotlib.image
 from cycler import cycler
 
-from .xmgrace import export_to_agr, load_agr_data
+from .xmgrace import (export_to_agr, load_agr_data, load_agr_dir, iter_agr_sets, AgrArchive,
+                      ExportStats, figure_hash, read_agr_hash, prepare_agr, get_stats,
+                      AgrDocument, Layout, layout_lock)
 from .tud import tudcolors, nominal_colors, sequential_colors
 from .utils import facet_plot, CurvedText as curved_text
 
@@ -45,17 +54,209 @@ def activate(scheme='b', full=False, sequential=False, cmap='blue-red', **kwargs
     mpl.rcParams['axes.prop_cycle'] = cycler('color', colors)
 
 
-def saveagr(filename, figure=None, convert_latex=True):
+# Maximum number of background exports, that are queued or running.
+# This is read by each background export, hence it may be changed at any time.
+background_limit = 4
+_background = {'executor': None, 'pending': 0}
+_background_lock = threading.Condition()
+
+
+def _release_background(future=None):
+    with _background_lock:
+        _background['pending'] -= 1
+        _background_lock.notify_all()
+
+
+def _submit_background(function, *args):
+    """
+    Run a function on the background writer thread and return its Future.
+
+    If `background_limit` exports are pending, this blocks until one of them is done,
+    such that the memory held by queued exports is bounded.
+    """
+    with _background_lock:
+        if _background['executor'] is None:
+            _background['executor'] = ThreadPoolExecutor(max_workers=1)
+        while _background['pending'] >= max(background_limit, 1):
+            _background_lock.wait()
+        _background['pending'] += 1
+    try:
+        future = _background['executor'].submit(function, *args)
+    except BaseException:
+        _release_background()
+        raise
+    future.add_done_callback(_release_background)
+    return future
+
+
+def _write_agr(agr, filename, stats, digest):
+    if hasattr(filename, 'write'):
+        agr.write(filename, stats=stats)
+    else:
+        agr.save(filename, stats=stats)
+    stats.finish()
+    return digest
+
+
+def saveagr(filename, figure=None, convert_latex=True, precision=None, palette=None,
+            downsample=None, profile=None, cache=False, background=False, layout=None):
     """
     Save the current figure in xmgrace format.
 
     Args:
-        filename: Agrfile to save the figure to
+        filename: Agrfile to save the figure to, may also be an open file or buffer
         figure (opt.):
             Figure that will be saved, if not given the current figure is saved
+        convert_latex (opt.): If latex strings will be converted to xmgrace.
+        precision (opt.):
+            Number of significant digits of the data, or 'auto' to choose it from
+            the resolution of the plot.
+        palette (opt.):
+            Restrict the colors to a palette, 'tud' for the nearest TU colors or a
+            number N to reduce the colors of the figure to N colors.
+        downsample (opt.):
+            Reduce the points of large lines to the resolution of the plot,
+            either with 'minmax' or 'lttb'.
+        profile (opt.):
+            An ExportStats or a callback, which receives the wall time of each phase
+            of the export, see `tudplot.xmgrace.ExportStats`.
+        cache (opt.):
+            Store a hash of the figure in the agr file and skip the export if the file
+            is up to date. The hash is returned, see `tudplot.xmgrace.figure_hash`.
+        background (opt.):
+            If True, only the attributes of the figure are extracted on the calling thread.
+            The data is formatted and written by a background thread and a Future is
+            returned, whose result is the hash (or None). At most `background_limit`
+            exports are pending at a time, further calls block until one is finished.
+        layout (opt.):
+            The `tudplot.xmgrace.Layout` of a previous draw of the figure, by default
+            the layout is computed by a draw without rendering.
+    """
+    figure = figure or pyplot.gcf()
+    if not background:
+        return export_to_agr(figure, filename, convert_latex=convert_latex, precision=precision,
+                             palette=palette, downsample=downsample, profile=profile,
+                             cache=cache, layout=layout)
+    stats = get_stats(profile)
+    agr, digest = prepare_agr(figure, filename, convert_latex=convert_latex, precision=precision,
+                              palette=palette, downsample=downsample, cache=cache, stats=stats,
+                              layout=layout)
+    if agr is None:
+        future = Future()
+        future.set_result(digest)
+        stats.finish()
+        return future
+    return _submit_background(_write_agr, agr, filename, stats, digest)
+
+
+def _canvas_is_png(figure, kwargs):
+    """
+    Check if the canvas of a figure, drawn at the figure dpi, looks the same as a saved png.
+    """
+    rc = mpl.rcParams
+    facecolor = rc['savefig.facecolor']
+    edgecolor = rc['savefig.edgecolor']
+    return (not kwargs and rc['savefig.dpi'] in ('figure', figure.dpi) and
+            not rc['savefig.transparent'] and rc['savefig.bbox'] != 'tight' and
+            (facecolor == 'auto' or to_rgba(facecolor) == to_rgba(figure.get_facecolor())) and
+            (edgecolor == 'auto' or to_rgba(edgecolor) == to_rgba(figure.get_edgecolor())))
+
+
+def save(figure, basename, formats=('pdf', 'png', 'agr'), convert_latex=True, precision=None,
+         palette=None, downsample=None, cache=False, **kwargs):
+    """
+    Save a figure in several formats at once, e.g. for a report.
+
+    If a png is saved and no savefig options are given that change the image (like dpi or
+    bbox_inches), the figure is rendered once by its Agg canvas. The png file is written
+    from the rendered image and the draw provides the layout of the agr export. Otherwise
+    the agr export computes its layout without rendering. Other formats are rendered by
+    savefig, while the agr file is written by the background writer.
+
+    Args:
+        figure: The matplotlib figure, if None the current figure is saved
+        basename: Name of the files without extension
+        formats (opt.): The formats to save, 'agr' or any format supported by savefig
+        convert_latex, precision, palette, downsample, cache (opt.):
+            Options of the agr export, see `saveagr`
+        **kwargs: Keyword arguments of savefig, like dpi
+
+    Returns:
+        List of the names of the saved files
     """
     figure = figure or pyplot.gcf()
-    export_to_agr(figure, filename, convert_latex=convert_latex)
+    filenames = OrderedDict(('{}.{}'.format(basename, fmt), fmt) for fmt in formats)
+    layout = None
+    # the Agg draw is only worth it if the png is written from it, otherwise the agr
+    # export uses a draw without rendering and savefig renders the png by itself
+    reuse_png = ('png' in formats and isinstance(figure.canvas, FigureCanvasAgg) and
+                 _canvas_is_png(figure, kwargs))
+    if reuse_png:
+        with layout_lock:
+            figure.canvas.draw()
+        renderer = figure.canvas.get_renderer()
+        layout = Layout(figure, renderer=renderer)
+    future = None
+    if 'agr' in formats:
+        future = saveagr(basename + '.agr', figure, convert_latex=convert_latex,
+                         precision=precision, palette=palette, downsample=downsample,
+                         cache=cache, background=True, layout=layout)
+    for fname, fmt in filenames.items():
+        if fmt == 'png' and reuse_png:
+            image = numpy.frombuffer(renderer.buffer_rgba(), dtype=numpy.uint8)
+            image = image.reshape(int(renderer.height), int(renderer.width), 4)
+            mpl.image.imsave(fname, image, dpi=figure.dpi, format='png')
+        elif fmt != 'agr':
+            figure.savefig(fname, format=fmt, **kwargs)
+    if future is not None:
+        future.result()
+    return list(filenames)
+
+
+def _saveagr_task(figure, filename, kwargs):
+    if callable(figure):
+        figure = figure()
+        try:
+            export_to_agr(figure, filename, **kwargs)
+        finally:
+            pyplot.close(figure)
+    else:
+        export_to_agr(figure, filename, **kwargs)
+
+
+def saveagr_many(figures, filenames, workers=None, processes=False, **kwargs):
+    """
+    Save many figures in xmgrace format in parallel.
+
+    Args:
+        figures:
+            Matplotlib figures or functions that create a figure. Functions are
+            called in the worker, figures created by them are closed after the export.
+        filenames: Agrfiles to save the figures to
+        workers (opt.): Number of parallel workers
+        processes (opt.):
+            If True, a process pool is used instead of threads. Figures and functions
+            have to be picklable in this case, e.g. module level functions.
+        **kwargs: Keyword arguments of `export_to_agr`, like convert_latex or precision.
+
+    With threads, the layout of the figures (see `tudplot.xmgrace.layout_lock`) is
+    computed by one export at a time, since the mathtext parser of matplotlib is not
+    thread-safe. Figures should not be drawn by other threads during the exports.
+
+    Returns:
+        OrderedDict with the filenames as keys and None or the exception
+        that was raised during the export as values.
+    """
+    Executor = ProcessPoolExecutor if processes else ThreadPoolExecutor
+    results = OrderedDict()
+    with Executor(max_workers=workers) as pool:
+        futures = [(fname, pool.submit(_saveagr_task, fig, fname, kwargs))
+                   for fig, fname in zip(figures, filenames)]
+        for fname, future in futures:
+            results[fname] = future.exception()
+            if results[fname] is not None:
+                logging.warning('Could not save {}: {!r}'.format(fname, results[fname]))
+    return results
 
 
 def markfigure(x, y, s, ax=None, **kwargs):
@@ -1,27 +1,14 @@
-
-from collections import OrderedDict
+from functools import lru_cache
 import logging
 import re
 
-patterns = OrderedDict()
-patterns['\$'] = ''
-patterns['¹'] = r'\S1\N'
-patterns['²'] = r'\S2\N'
-patterns['³'] = r'\S3\N'
-patterns['⁴'] = r'\S4\N'
-patterns['⁵'] = r'\S5\N'
-patterns['⁶'] = r'\S6\N'
-patterns['⁷'] = r'\S7\N'
-patterns['⁸'] = r'\S8\N'
-patterns['⁹'] = r'\S9\N'
-patterns['⁻'] = r'\S-\N'
-patterns[r'\\,'] = r'\-\- \+\+'
-patterns[r'\\[;:.]'] = ''
-patterns[r'\\math(?:tt|sf|it|rm)({[^}]+})'] = r'\1'
-patterns[r'\^({[^}]+}|.)'] = r'\S\1\N'
-patterns[r'\_({[^}]+}|.)'] = r'\s\1\N'
-# Remove any left over latex groups as the last step
-patterns[r'[{}]'] = ''
+# Single tokens and their xmgrace replacement, latex groups are removed
+symbols = {
+    '{': '', '}': '',
+    '¹': r'\S1\N', '²': r'\S2\N', '³': r'\S3\N', '⁴': r'\S4\N', '⁵': r'\S5\N',
+    '⁶': r'\S6\N', '⁷': r'\S7\N', '⁸': r'\S8\N', '⁹': r'\S9\N', '⁻': r'\S-\N',
+    r'\,': r'\-\- \+\+', r'\;': '', r'\:': '', r'\.': '',
+}
 
 # Greek letters in xmgrace are written by switching to symbol-font:
 # "\x a\f{}" will print an alpha and switch back to normal font
@@ -32,18 +19,78 @@ greek = {
     'tau': 't', 'upsilon': 'u', 'phi': 'f', 'chi': 'c', 'psi': 'y', 'omega': 'w',
     'varphi': 'j', 'varepsilon': 'e', 'vartheta': 'J', 'varrho': 'r',
     'Phi': 'F',
-    'langle': r'\#{{e1}}', 'rangle': r'\#{{f1}}', 'infty': r'\c%\C', 'cdot': r'\#{{d7}}',
-    'sqrt': r'\#{{d6}}', 'propto': r'\#{{b5}}',
+    'langle': r'\#{e1}', 'rangle': r'\#{f1}', 'infty': r'\c%\C', 'cdot': r'\#{d7}',
+    'sqrt': r'\#{d6}', 'propto': r'\#{b5}',
 }
-for latex, xmg in greek.items():
-    patt = r'\\{}'.format(latex)
-    repl = r'\\x {}\\f{{{{}}}}'.format(xmg)
-    patterns[patt] = repl
+
+# A latex group with at most one level of nested groups
+_group = r'\{(?:[^{}]|\{[^{}]*\})*\}'
+_math = r'\\math(?:tt|sf|it|rm)'
+
+
+class LatexTranslator:
+    """
+    Translate latex strings to xmgrace in a single scan.
+
+    All tokens are matched by one alternation, longest first, and replaced by a lookup in a
+    dispatch table. Sub- and superscripts and the arguments of \\mathrm and similar commands
+    are translated recursively. Results are cached, since the same labels are converted
+    over and over again.
+    """
+
+    def __init__(self, escape_braces=True, cache_size=4096):
+        """
+        Args:
+            escape_braces (opt.):
+                If braces in the replacements are doubled, such that the result may be passed
+                through `str.format`, as the agr writer of `tudplot.xmgrace` does.
+            cache_size (opt.): Maximum number of cached strings.
+        """
+        self.table = dict(symbols)
+        for latex, xmg in greek.items():
+            self.table['\\' + latex] = r'\x {}\f{{}}'.format(xmg)
+        if escape_braces:
+            for token, repl in self.table.items():
+                self.table[token] = repl.replace('{', '{{').replace('}', '}}')
+        tokens = sorted(self.table, key=len, reverse=True)
+        self.pattern = re.compile(
+            r'(?P<script>[\^_])(?P<arg>' + _group + '|' + _math + _group + r'|\\[A-Za-z]+|.)|' +
+            _math + '(?P<math>' + _group + ')|' +
+            '|'.join(re.escape(t) for t in tokens)
+        )
+        self.special = re.compile('[' + re.escape('\\$^_{}¹²³⁴⁵⁶⁷⁸⁹⁻') + ']')
+        self.convert = lru_cache(maxsize=cache_size)(self._convert)
+
+    def _replace(self, match):
+        script = match.group('script')
+        if script is not None:
+            return (r'\S' if script == '^' else r'\s') + self._sub(match.group('arg')) + r'\N'
+        math = match.group('math')
+        if math is not None:
+            return self._sub(math)
+        return self.table[match.group(0)]
+
+    def _sub(self, string):
+        return self.pattern.sub(self._replace, string)
+
+    def _convert(self, string):
+        result = self._sub(string.replace('$', ''))
+        logging.debug('Convert to xmgrace: %s -> %s', string, result)
+        return result
+
+    def __call__(self, string):
+        if self.special.search(string) is None:
+            return string
+        return self.convert(string)
+
+
+_translator = LatexTranslator()
 
 
 def latex_to_xmgrace(string):
-    logging.debug('Convert to xmgrace: {}'.format(string))
-    for patt, repl in patterns.items():
-        string = re.sub(patt, repl, string)
-    logging.debug('To -> {}'.format(string))
-    return string
+    """
+    Convert a latex string to xmgrace format.
+
+    The braces in the result are escaped for `str.format`.
+    """
+    return _translator(string)
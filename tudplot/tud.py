@@ -40,3 +40,52 @@ def sequential_colors(N, cmap='blue-red', min=0, max=1):
     else:
         cmap = mpl.pyplot.get_cmap(cmap)
     return ['#{:02x}{:02x}{:02x}'.format(*cmap(x, bytes=True)[:3]) for x in numpy.linspace(min, max, N)]
+
+
+def nearest_colors(colors, palette):
+    """
+    Find the nearest palette color of some colors, by their distance in RGB space.
+
+    Args:
+        colors: List of matplotlib colors
+        palette: List of matplotlib colors to choose from
+
+    Returns:
+        Array with the index of the nearest palette color for each color
+    """
+    rgb = mpl.colors.to_rgba_array(colors)[:, :3]
+    pal = mpl.colors.to_rgba_array(palette)[:, :3]
+    dist = ((rgb[:, numpy.newaxis, :] - pal[numpy.newaxis, :, :])**2).sum(axis=-1)
+    return dist.argmin(axis=1)
+
+
+def cluster_colors(colors, N, iterations=20):
+    """
+    Reduce a list of colors to N representative colors, by k-means clustering in RGB space.
+
+    Args:
+        colors: List of matplotlib colors
+        N: Number of colors
+        iterations (opt.): Maximal number of iterations of the clustering
+
+    Returns:
+        List of at most N colors as hex strings
+    """
+    rgb = numpy.unique(mpl.colors.to_rgba_array(colors)[:, :3], axis=0)
+    if len(rgb) > N:
+        # start with colors that are far apart from each other
+        centers = [rgb[0]]
+        dist = ((rgb - rgb[0])**2).sum(axis=1)
+        for _ in range(N - 1):
+            centers.append(rgb[dist.argmax()])
+            dist = numpy.minimum(dist, ((rgb - centers[-1])**2).sum(axis=1))
+        centers = numpy.array(centers)
+        for _ in range(iterations):
+            labels = nearest_colors(rgb, centers)
+            new_centers = numpy.array([rgb[labels == i].mean(axis=0) if (labels == i).any() else c
+                                       for i, c in enumerate(centers)])
+            if numpy.allclose(new_centers, centers):
+                break
+            centers = new_centers
+        rgb = centers
+    return [mpl.colors.to_hex(c) for c in rgb]
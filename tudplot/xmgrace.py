@@ -1,16 +1,124 @@
 
+import os
 import re
+import gzip
+import bz2
+import lzma
+import mmap
+import json
+import shutil
+import hashlib
+import tempfile
+import glob
 import logging
+import time
+import threading
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from collections import OrderedDict
-
-from matplotlib.colors import ColorConverter
+from collections.abc import Mapping
+from operator import methodcaller
+
+from matplotlib import rcParams
+from matplotlib.colors import to_rgba, to_hex
+from matplotlib.ticker import MaxNLocator
+from matplotlib.transforms import Bbox
+from matplotlib.backend_bases import RendererBase
+from matplotlib.backends.backend_agg import FigureCanvasAgg, RendererAgg
 from matplotlib.cbook import is_string_like
 import numpy as np
 
-from .tud import tudcolors
+from .tud import tudcolors, nearest_colors, cluster_colors
 from .tex2grace import latex_to_xmgrace
 
 
+# Reverse lookup of the TU color names, by RGBA value
+tudcolor_names = {to_rgba(color): name for name, color in tudcolors.items() if isinstance(color, str)}
+
+
+class ColorRegistry:
+    """
+    The color map of a single agr file.
+
+    Colors are identified by their normalized RGBA value, such that different spellings
+    of the same color share one entry. Lookups are done in a dictionary.
+
+    The map may be restricted to a palette with `set_palette`, then each new color
+    is replaced by the nearest color of the palette.
+    """
+
+    def __init__(self, colors=('white', 'black')):
+        """
+        Args:
+            colors (opt.): Initial colors of the map, by default white and black.
+        """
+        self.colors = []
+        self.palette = None
+        self._indices = {}
+        self._lookup = {}
+        self._nearest = {}
+        for color in colors:
+            self.index(color)
+
+    def set_palette(self, palette, colors=()):
+        """
+        Restrict the color map to a palette.
+
+        Args:
+            palette:
+                The palette, this may be 'tud' for the TU colors, a list of colors,
+                or a number N in which case `colors` are clustered to N colors.
+                The initial colors of the map are always part of the palette.
+            colors (opt.):
+                The colors that will be added to the map. The nearest palette colors
+                of all of them are determined at once.
+        """
+        colors = [color for color in colors if to_rgba(color)[3] > 0]
+        if palette == 'tud':
+            palette = [tudcolors[name] for name in tudcolor_names.values()]
+        elif isinstance(palette, int):
+            palette = cluster_colors(colors, palette) if len(colors) > 0 else []
+        self.palette = [color for color, _ in self.colors] + list(palette)
+        self._nearest = {}
+        if len(colors) > 0:
+            for color, i in zip(colors, nearest_colors(colors, self.palette)):
+                self._nearest[to_rgba(color)] = self.palette[i]
+
+    def index(self, color):
+        """
+        Get the index of a color in the map, the color is added if it is not present.
+        """
+        try:
+            return self._lookup[color]
+        except (KeyError, TypeError):
+            pass
+        rgba = to_rgba(color)
+        # transparent colors, e.g. of hollow markers, are kept as they are
+        if rgba not in self._indices and self.palette is not None and rgba[3] > 0:
+            if rgba not in self._nearest:
+                self._nearest[rgba] = self.palette[nearest_colors([rgba], self.palette)[0]]
+            color = self._nearest[rgba]
+            rgba = to_rgba(color)
+        if rgba not in self._indices:
+            self._indices[rgba] = len(self.colors)
+            self.colors.append((color, rgba))
+        index = self._indices[rgba]
+        try:
+            self._lookup[color] = index
+        except TypeError:
+            pass
+        return index
+
+    def __iter__(self):
+        """
+        Iterate over the entries of the map as tuples (index, color, rgba).
+        """
+        for i, (color, rgba) in enumerate(self.colors):
+            yield i, color, rgba
+
+    def __len__(self):
+        return len(self.colors)
+
+
 def indexed(list, default=None):
     def index(arg):
         for i, v in enumerate(list):
@@ -20,27 +128,466 @@ def indexed(list, default=None):
     return index
 
 
+compressions = {
+    '.gz': (b'\x1f\x8b', gzip.open),
+    '.bz2': (b'BZh', bz2.open),
+    '.xz': (b'\xfd7zXZ\x00', lzma.open),
+}
+
+
+def open_agr(filename, mode='r'):
+    """
+    Open an agr file, which may be compressed with gzip, bzip2 or xz.
+
+    For writing, the compression is chosen from the file extension, e.g. '.agr.gz'.
+    For reading, it is detected from the first bytes of the file. Compressed files
+    are (de)compressed incrementally while they are read or written.
+
+    Args:
+        filename: Name of the agr file
+        mode (opt.): Either 'r' or 'w', the file is always opened in text mode.
+    """
+    if 'r' in mode:
+        with open(filename, 'rb') as f:
+            head = f.read(6)
+        opener = next((o for magic, o in compressions.values() if head.startswith(magic)), open)
+        return opener(filename, 'rt', errors='replace')
+    else:
+        _, opener = compressions.get(os.path.splitext(filename)[1], (None, open))
+        return opener(filename, 'wt')
+
+
+escape_table = str.maketrans({8: r'\b', 7: r'\a', 12: r'\f', 10: r'\n', 13: r'\r', 9: r'\t', 11: r'\v'})
+
+
 def escapestr(s):
-    raw_map = {8: r'\b', 7: r'\a', 12: r'\f', 10: r'\n', 13: r'\r', 9: r'\t', 11: r'\v'}
-    return r''.join(i if ord(i) > 32 else raw_map.get(ord(i), i) for i in s)
+    return s.translate(escape_table)
+
+
+class _Phase:
 
+    def __init__(self, stats, name):
+        self.stats = stats
+        self.name = name
 
-def get_viewport_coords(artist):
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *args):
+        times = self.stats.times
+        times[self.name] = times.get(self.name, 0) + time.perf_counter() - self.start
+
+
+class ExportStats:
+    """
+    Profile of an export or load: the wall time of each phase and counters.
+
+    The phases of an export are hash, layout, attributes (which includes latex), decimate,
+    format and write, those of a load are cache, parse and frame. The counters are bytes, sets and
+    points. Pass an instance as `profile` argument, or a callback which is called with the
+    stats when the export is finished.
+    """
+
+    def __init__(self, callback=None):
+        """
+        Args:
+            callback (opt.): A function that is called with the stats by `finish`.
+        """
+        self.times = OrderedDict()
+        self.counts = OrderedDict()
+        self.callback = callback
+
+    def phase(self, name):
+        """
+        Context manager that adds the time of its block to the phase name.
+        """
+        return _Phase(self, name)
+
+    def count(self, name, n=1):
+        self.counts[name] = self.counts.get(name, 0) + n
+
+    def finish(self):
+        if self.callback is not None:
+            self.callback(self)
+
+    def __str__(self):
+        lines = ['{:<12}{:10.4f} s'.format(k, v) for k, v in self.times.items()]
+        lines += ['{:<12}{:10d}'.format(k, v) for k, v in self.counts.items()]
+        return '\n'.join(lines)
+
+
+class _NullPhase:
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *args):
+        pass
+
+
+class NullStats:
+    """
+    Stats that record nothing, used when profiling is disabled.
+    """
+    _phase = _NullPhase()
+
+    def phase(self, name):
+        return self._phase
+
+    def count(self, name, n=1):
+        pass
+
+    def finish(self):
+        pass
+
+
+null_stats = NullStats()
+
+
+def get_stats(profile):
+    """
+    Get the stats object for the profile argument of an export or load.
+
+    Args:
+        profile: None to disable profiling, an ExportStats or a callback, see `ExportStats`
+    """
+    if profile is None or profile is False:
+        return null_stats
+    if isinstance(profile, (ExportStats, NullStats)):
+        return profile
+    if callable(profile):
+        return ExportStats(profile)
+    raise TypeError('profile must be an ExportStats or a callable, not {}'.format(type(profile)))
+
+
+def format_data(data, precision=None, finite=True, chunksize=100000):
+    """
+    Format the rows of an array as the lines of an agr data block.
+
+    Values are formatted like ``str()`` does, unless a precision is given.
+    The formatting is done in bulk for blocks of rows.
+
+    Args:
+        data: Array of shape (N, M) with the data points
+        precision (opt.):
+            Number of significant digits of the values, either a single number or
+            one number for each column. If None, values are written with full precision.
+        finite (opt.): If True, rows which contain non-finite values are skipped.
+        chunksize (opt.): Number of rows that are formatted at once
+
+    Yields:
+        str: Formatted lines of at most `chunksize` rows
+    """
+    # the conversion and the filter are done per chunk, such that the data is not copied
+    data = np.asarray(data)
+    if precision is None:
+        fmts = ['%r'] * data.shape[1]
+    else:
+        fmts = ['%.{}g'.format(p) for p in np.broadcast_to(precision, data.shape[1])]
+    line = ' '.join(fmts) + '\n'
+    for i in range(0, len(data), chunksize):
+        rows = np.asarray(data[i:i + chunksize], dtype=float)
+        if finite:
+            rows = rows[np.isfinite(rows).all(axis=1)]
+        yield (line * len(rows)) % tuple(rows.ravel().tolist())
+
+
+def auto_precision(data, axis, pagesize, oversampling=10):
+    """
+    Get the number of significant digits that are needed to write the data of a line.
+
+    The precision is chosen such that the rounding error of the values is
+    smaller than a fraction of a pixel of the agr page.
+
+    Args:
+        data: Array of shape (N, 2) with the data of the line
+        axis: The matplotlib axis of the line
+        pagesize: Width and height of the figure on the agr page in pixels
+        oversampling (opt.): Number of distinguishable values per pixel
+
+    Returns:
+        Tuple with the number of digits for the x and y values
+    """
+    box = axis.get_position()
+    pixels = np.array([box.width, box.height]) * pagesize * oversampling
+    limits = (axis.get_xlim(), axis.get_ylim())
+    scales = (axis.get_xscale(), axis.get_yscale())
+    digits = []
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for lim, scale, values, npix in zip(limits, scales, np.asarray(data).T, pixels):
+            if 'log' in scale:
+                # relative resolution of one pixel
+                digits10 = -np.log10(abs(np.log(lim[1] / lim[0])) / npix)
+            else:
+                values = np.abs(values[np.isfinite(values)])
+                vmax = np.abs(lim).max()
+                if len(values) > 0:
+                    vmax = max(vmax, values.max())
+                digits10 = np.log10(vmax * npix / abs(lim[1] - lim[0]))
+            if not np.isfinite(digits10):
+                digits10 = 17
+            digits.append(int(np.clip(np.ceil(digits10) + 1, 1, 17)))
+    return tuple(digits)
+
+
+def _finite_rows(data):
+    """
+    Get the finite rows of an array, which is only copied if it has non-finite values.
+    """
+    data = np.asarray(data, dtype=float)
+    finite = np.isfinite(data).all(axis=1)
+    if finite.all():
+        return data
+    return data[finite]
+
+
+def minmax_decimate(data, nbuckets, limits=None, log=False):
+    """
+    Reduce a line to the first, last, minimal and maximal point of each x-bucket.
+
+    The x range is divided into `nbuckets` buckets of equal width, e.g. the pixels of the
+    plot. Since all extrema and the points where the line enters or leaves a bucket are
+    kept, the reduced line looks the same as the original when drawn at this resolution.
+    Points outside of the limits are collected in one bucket on each side.
+
+    Args:
+        data: Array of shape (N, 2) with the data points
+        nbuckets: Number of buckets
+        limits (opt.): The x range of the buckets, by default the range of the data.
+        log (opt.): If the buckets are spaced logarithmically.
+
+    Returns:
+        Array with the selected points, in their original order
+    """
+    data = _finite_rows(data)
+    if len(data) <= 4 * nbuckets:
+        return data
+    x, y = data[:, 0], data[:, 1]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if log:
+            x = np.log10(x)
+            limits = np.log10(limits) if limits is not None else None
+        if limits is None:
+            limits = np.nanmin(x), np.nanmax(x)
+        bucket = np.floor((x - limits[0]) / (limits[1] - limits[0]) * nbuckets)
+    bucket = np.clip(np.nan_to_num(bucket), -1, nbuckets)
+
+    order = np.lexsort((y, bucket))
+    step = np.diff(bucket[order]) != 0
+    _, first = np.unique(bucket, return_index=True)
+    _, last = np.unique(bucket[::-1], return_index=True)
+    keep = np.concatenate([
+        order[np.r_[True, step]], order[np.r_[step, True]], first, len(data) - 1 - last
+    ])
+    return data[np.unique(keep)]
+
+
+def lttb_decimate(data, npoints):
+    """
+    Reduce a line to a number of points with the Largest-Triangle-Three-Buckets algorithm.
+
+    The points are divided into buckets of equal size, from each bucket the point
+    is selected that forms the largest triangle with the point selected from the
+    previous bucket and the mean of the next bucket.
+
+    Args:
+        data: Array of shape (N, 2) with the data points
+        npoints: Number of points of the reduced line
+
+    Returns:
+        Array with the selected points, in their original order
+    """
+    data = _finite_rows(data)
+    N = len(data)
+    if npoints >= N or npoints < 3:
+        return data
+    edges = np.linspace(1, N - 1, npoints - 1).astype(int)
+    means = np.add.reduceat(data[:N - 1], edges[:-1]) / np.diff(edges)[:, np.newaxis]
+    means = np.vstack([means[1:], data[-1:]])
+
+    selected = np.empty(npoints, dtype=int)
+    selected[0] = 0
+    selected[-1] = N - 1
+    a = data[0]
+    for i in range(npoints - 2):
+        points = data[edges[i]:edges[i + 1]]
+        c = means[i]
+        area = np.abs((a[0] - c[0]) * (points[:, 1] - a[1]) - (a[0] - points[:, 0]) * (c[1] - a[1]))
+        selected[i + 1] = edges[i] + area.argmax()
+        a = data[selected[i + 1]]
+    return data[selected]
+
+
+def decimate(data, method, nbuckets, limits=None, log=False):
+    """
+    Reduce the number of points of a line, see `minmax_decimate` and `lttb_decimate`.
+
+    Only lines without markers are decimated by the exporters (see `has_markers`), since
+    each point of a line with markers is visible. LTTB needs sorted x values, hence lines
+    whose x values are not monotonic are reduced with 'minmax' instead.
+
+    Args:
+        data: Array of shape (N, 2) with the data points
+        method: Either 'minmax' or 'lttb'
+        nbuckets: Number of buckets, this is also the number of points for 'lttb'.
+        limits (opt.): The x range of the buckets for 'minmax'
+        log (opt.): If the x axis is logarithmic, for 'minmax'
+    """
+    if method == 'minmax':
+        return minmax_decimate(data, nbuckets, limits=limits, log=log)
+    elif method == 'lttb':
+        data = _finite_rows(data)
+        dx = np.diff(data[:, 0])
+        if (dx >= 0).all() or (dx <= 0).all():
+            return lttb_decimate(data, nbuckets)
+        return minmax_decimate(data, nbuckets, limits=limits, log=log)
+    else:
+        raise ValueError('Unknown decimation method: {}'.format(method))
+
+
+def has_markers(line):
+    """
+    Check if a line draws markers, such lines are not decimated.
+    """
+    return line.get_marker() not in ('None', '', ' ', None)
+
+
+def decimation_params(axis, pagesize, method):
+    """
+    Get the arguments of `decimate` for the lines of an axis.
+
+    The number of buckets is the width of the axis on the agr page in pixels.
+    """
+    nbuckets = max(int(axis.get_position().width * pagesize[0]), 1)
+    return {'method': method, 'nbuckets': nbuckets, 'limits': axis.get_xlim(),
+            'log': 'log' in axis.get_xscale()}
+
+
+# The layout of texts runs the mathtext parser of matplotlib, which is not thread-safe.
+# Hence layout draws and extent lookups of concurrent exports are serialized by this lock.
+layout_lock = threading.RLock()
+
+
+def _no_op(*args, **kwargs):
+    pass
+
+
+def draw_layout(figure):
+    """
+    Draw a figure to compute the layout of its artists, and return the renderer.
+
+    The figure is drawn with rendering disabled, such that the extents of texts and legends
+    are computed without rasterizing the data of the lines. For matplotlib versions that
+    do not support this, the draw methods of the renderer are replaced by no-ops during
+    the draw. The renderer of an Agg canvas is reused, since it caches the parsed mathtext.
+    """
+    with layout_lock:
+        return _draw_layout(figure)
+
+
+def _draw_layout(figure):
+    if hasattr(figure, 'draw_without_rendering'):
+        figure.draw_without_rendering()
+        return figure._get_renderer()
+    if figure.canvas is None:
+        FigureCanvasAgg(figure)
+    if hasattr(figure.canvas, 'get_renderer'):
+        renderer = figure.canvas.get_renderer()
+    else:
+        width, height = figure.bbox.size
+        renderer = RendererAgg(width, height, figure.dpi)
+    disabled = [name for name in dir(RendererBase)
+                if name.startswith('draw_') or name in ('open_group', 'close_group')]
+    saved = {name: renderer.__dict__[name] for name in disabled if name in renderer.__dict__}
+    for name in disabled:
+        setattr(renderer, name, _no_op)
+    try:
+        figure.draw(renderer)
+    finally:
+        for name in disabled:
+            delattr(renderer, name)
+        renderer.__dict__.update(saved)
+    return renderer
+
+
+class Layout:
+    """
+    The layout of a figure, which is computed once per export.
+
+    The figure is drawn once without rendering (see `draw_layout`), the transforms of the
+    figure are computed once and the window extents of all artists are cached.
+    """
+
+    def __init__(self, figure, renderer=None):
+        """
+        Args:
+            figure: The matplotlib figure
+            renderer (opt.): The renderer of a previous draw of the figure, which is reused
+        """
+        self.figure = figure
+        self.renderer = renderer if renderer is not None else draw_layout(figure)
+        fxy = figure.get_size_inches()
+        self.scale = fxy / fxy.min()
+        self.figure_inverted = figure.transFigure.inverted()
+        self._data_inverted = {}
+        self._extents = {}
+
+    def window_extent(self, artist):
+        """
+        Get the (cached) window extent of an artist.
+        """
+        key = id(artist)
+        if key not in self._extents:
+            with layout_lock:
+                self._extents[key] = artist.get_window_extent(self.renderer)
+        return self._extents[key]
+
+    def data_inverted(self, axis):
+        """
+        Get the (cached) inverted data transform of an axis.
+        """
+        key = id(axis)
+        if key not in self._data_inverted:
+            self._data_inverted[key] = axis.transData.inverted()
+        return self._data_inverted[key]
+
+    def viewport_coords(self, artist):
+        """
+        Get the viewport coordinates of an artist.
+        """
+        return self.figure_inverted.transform(self.window_extent(artist)) * self.scale[np.newaxis, :]
+
+    def world_coords(self, artist):
+        """
+        Get the world coordinates of an artist.
+        """
+        return self.data_inverted(artist.axes).transform(self.window_extent(artist))
+
+
+def get_viewport_coords(artist, layout=None):
     """
     Get the viewport coordinates of an artist.
     """
+    if layout is not None:
+        return layout.viewport_coords(artist)
     fxy = artist.figure.get_size_inches()
     fxy /= fxy.min()    
     trans = artist.figure.transFigure.inverted()
-    return trans.transform(artist.get_window_extent()) * fxy[np.newaxis, :]
+    with layout_lock:
+        extent = artist.get_window_extent()
+    return trans.transform(extent) * fxy[np.newaxis, :]
 
 
-def get_world_coords(artist):
+def get_world_coords(artist, layout=None):
     """
     Get the world coordinates of an artist.
     """
+    if layout is not None:
+        return layout.world_coords(artist)
     trans = artist.axes.transData.inverted()
-    return trans.transform(artist.get_window_extent())
+    with layout_lock:
+        extent = artist.get_window_extent()
+    return trans.transform(extent)
 
 
 def get_world(axis):
@@ -86,6 +633,30 @@ def get_ticklabels_on(dim):
     return get_ticklabels
 
 
+def get_ticklabels_state(dim):
+    def get_state(axis):
+        # the tick labels are only updated by a draw, hence they are formatted here like in a draw
+        tickaxis = getattr(axis, f'{dim}axis')
+        locs = tickaxis.get_majorticklocs()
+        formatter = tickaxis.get_major_formatter()
+        formatter.set_locs(locs)
+        return [formatter(loc, i) for i, loc in enumerate(locs)]
+    return get_state
+
+
+def get_legend_state(axis):
+    leg = axis.get_legend()
+    if leg is None:
+        return None
+    return (getattr(leg, '_loc', None), leg.get_bbox_to_anchor().bounds,
+            [t.get_text() for t in leg.get_texts()])
+
+
+def get_text_state(text):
+    return (text.get_position(), getattr(text, 'xy', None), text.get_fontsize(),
+            text.get_horizontalalignment(), text.get_verticalalignment(), text.get_rotation())
+
+
 def get_legend(axis):
     if axis.get_legend() is not None:
         return 'on'
@@ -93,16 +664,25 @@ def get_legend(axis):
         return 'off'
 
 
-def get_legend_position(axis):
+def get_legend_position(axis, layout=None):
     leg = axis.get_legend()
     if leg is not None:
-        return '{:.3f}, {:.3f}'.format(*get_viewport_coords(leg).mean(axis=0))
+        return '{:.3f}, {:.3f}'.format(*get_viewport_coords(leg, layout).mean(axis=0))
     else:
         return '0, 0'
 
 
-def get_text_position(text):
-    return '{:.3f}, {:.3f}'.format(*get_viewport_coords(text)[0])
+def get_text_position(text, layout=None):
+    return '{:.3f}, {:.3f}'.format(*get_viewport_coords(text, layout)[0])
+
+
+def get_fillstyle(line):
+    """
+    Get the fill style of the markers of a line, which is 'none' for transparent faces.
+    """
+    if to_rgba(line.get_markerfacecolor())[3] == 0:
+        return 'none'
+    return line.get_fillstyle()
 
 
 def get_arrow_coordinates(text):
@@ -146,21 +726,23 @@ class ValueAttribute(StaticAttribute):
         'linestyle': ('None', '-', ':', '--', None, '-.', None, None, None),
         'marker': (('', 'None'), 'o', 's', 'd', '^', '<', 'v', '>', '+', 'x', '*'),
         'fillstyle': ('none', 'full', ),
-        'color': ['white', 'black'],
+        'color': ('white', 'black'),
     }
 
-    def _get_value(self, source, convert_latex=True):
-        value = getattr(source, 'get_{}'.format(self.key))()
-        if isinstance(value, str):
+    def _get_value(self, source, convert_latex=True, stats=null_stats, **kwargs):
+        value = self._getter(source)
+        # values of indexed attributes are looked up as they are
+        if isinstance(value, str) and not self.index:
             if convert_latex:
-                value = latex_to_xmgrace(value)
+                with stats.phase('latex'):
+                    value = latex_to_xmgrace(value)
             else:
                 value = value.replace(r'{}', r'{{}}').replace('{{{}}}', '{{}}')
-            if not self.index:
-                value = '"{}"'.format(value)
+            value = '"{}"'.format(value)
         return value
 
-    def __init__(self, *args, index=None, function=None, condition=None):
+    def __init__(self, *args, index=None, function=None, condition=None, layout=False,
+                 fingerprint=None):
         """
         Args:
             *args: Arguments of super().__init__()
@@ -168,9 +750,14 @@ class ValueAttribute(StaticAttribute):
                 True if value should be mapped to an index. If this is a str this will
                 be used as the index lists key.
             function: A function that is used to fetch the value from the source.
+            layout (opt.): True if the function takes the `Layout` of the export as second argument.
             condition: A function that decides if the attribute is written to the agr file.
+            fingerprint (opt.):
+                A function that returns the state of the source, on which the value depends,
+                for `figure_hash`. This is needed if the value is only known after a draw.
         """
         super().__init__(*args)
+        self._getter = methodcaller('get_{}'.format(self.key))
 
         if index:
             if index is True:
@@ -182,14 +769,42 @@ class ValueAttribute(StaticAttribute):
             self.index = False
 
         if function is not None:
-            self._get_value = lambda x, **kwargs: function(x)
+            if layout:
+                self._get_value = lambda x, layout=None, **kwargs: function(x, layout)
+            else:
+                self._get_value = lambda x, **kwargs: function(x)
         self.condition = condition or (lambda x: True)
+        self._fingerprint = fingerprint
 
-    def format(self, source, convert_latex=True, **kwargs):
-        value = self._get_value(source, convert_latex=convert_latex)
+    def fingerprint(self, source):
+        """
+        Return the value of the attribute for `figure_hash`, without a draw of the figure.
+        """
+        if self._fingerprint is not None:
+            return self._fingerprint(source)
+        return self._get_value(source, convert_latex=False)
+
+    def format(self, source, convert_latex=True, colors=None, layout=None, stats=null_stats,
+               **kwargs):
+        """
+        Return the formatted string of the attribute.
+
+        Args:
+            source: The python object, from which the value is taken
+            convert_latex (opt.): If latex strings are converted to xmgrace
+            colors (opt.): The ColorRegistry of the agr file, which maps colors to indices
+            layout (opt.): The Layout of the figure
+            stats (opt.): The ExportStats of the export
+        """
+        value = self._get_value(source, convert_latex=convert_latex, layout=layout, stats=stats)
         if not self.condition(value):
             return None
-        if self.index:
+        if self.index == 'color':
+            # the color map is scoped to an export, the class level list is never changed
+            if colors is None:
+                colors = ColorRegistry(self.attr_lists['color'])
+            value = colors.index(value)
+        elif self.index:
             attr_list = self.attr_lists[self.index]
             index = indexed(attr_list)(str(value))
             if index is None:
@@ -200,7 +815,7 @@ class ValueAttribute(StaticAttribute):
                     print('index not found:', value, index, attr_list)
                     index = 1
             value = index
-        logging.debug('fmt: {}, value: {}'.format(self.fmt, value))
+        logging.debug('fmt: %s, value: %s', self.fmt, value)
         return ' '.join([self.fmt, str(value)])
 
 agr_line_attrs = [
@@ -211,7 +826,7 @@ agr_line_attrs = [
     ValueAttribute('linewidth', 'line linewidth'),
     ValueAttribute('color', 'line color', index=True),
     ValueAttribute('marker', 'symbol', index=True),
-    ValueAttribute('fillstyle', 'symbol fill pattern', index=True),
+    ValueAttribute('fillstyle', 'symbol fill pattern', index=True, function=get_fillstyle),
     ValueAttribute('markeredgecolor', 'symbol color', index='color'),
     ValueAttribute('markerfacecolor', 'symbol fill color', index='color'),
     ValueAttribute('markeredgewidth', 'symbol linewidth'),
@@ -231,27 +846,33 @@ agr_axis_attrs = [
     ValueAttribute('yscale', 'yaxes scale Logarithmic', condition=lambda scale: 'log' in scale),
     ValueAttribute('xticks', 'xaxis tick major', function=get_major_ticks('x')),
     ValueAttribute('yticks', 'yaxis tick major', function=get_major_ticks('y')),
-    ValueAttribute('xticklabels', 'xaxis ticklabel', function=get_ticklabels_on('x')),
-    ValueAttribute('yticklabels', 'yaxis ticklabel', function=get_ticklabels_on('y')),
+    ValueAttribute('xticklabels', 'xaxis ticklabel', function=get_ticklabels_on('x'),
+                   fingerprint=get_ticklabels_state('x')),
+    ValueAttribute('yticklabels', 'yaxis ticklabel', function=get_ticklabels_on('y'),
+                   fingerprint=get_ticklabels_state('y')),
     ValueAttribute('xlabelposition', 'xaxis label place', 
                    function=lambda ax: 'opposite' if ax.xaxis.get_label_position() == 'top' else 'normal'),
     ValueAttribute('xtickposition', 'xaxis ticklabel place', 
-                   function=lambda ax: 'opposite' if all([t.get_position()[1] >= 0.9 for t in ax.xaxis.get_ticklabels()]) else 'normal'),
+                   function=lambda ax: 'opposite' if all([t.get_position()[1] >= 0.9 for t in ax.xaxis.get_ticklabels()]) else 'normal',
+                   fingerprint=lambda ax: ax.xaxis.get_ticks_position()),
     ValueAttribute('ylabelposition', 'yaxis label place', 
                    function=lambda ax: 'opposite' if ax.yaxis.get_label_position() == 'right' else 'normal'),
     ValueAttribute('ytickposition', 'yaxis ticklabel place', 
-                   function=lambda ax: 'opposite' if all([t.get_position()[0] >= 0.9 for t in ax.yaxis.get_ticklabels()]) else 'normal'),
+                   function=lambda ax: 'opposite' if all([t.get_position()[0] >= 0.9 for t in ax.yaxis.get_ticklabels()]) else 'normal',
+                   fingerprint=lambda ax: ax.yaxis.get_ticks_position()),
 #                    tax.yaxis.get_ticks_position() == 'right' else 'normal'),
     ValueAttribute('legend', 'legend', function=get_legend),
     StaticAttribute('legend', 'legend loctype view'),
-    ValueAttribute('legend', 'legend', function=get_legend_position)
+    ValueAttribute('legend', 'legend', function=get_legend_position, layout=True,
+                   fingerprint=get_legend_state)
 ]
 
 agr_text_attrs = [
     StaticAttribute('string', 'on'),
     StaticAttribute('string', 'loctype view'),
     StaticAttribute('string', 'char size 1.0'),
-    ValueAttribute('position', '', function=get_text_position),
+    ValueAttribute('position', '', function=get_text_position, layout=True,
+                   fingerprint=get_text_state),
     ValueAttribute('text', 'def')
 ]
 
@@ -262,34 +883,94 @@ agr_arrow_attrs = [
     StaticAttribute('line', 'linewidth 3'),
     StaticAttribute('line', 'linestyle 1'),
     StaticAttribute('line', 'arrow 2'),
-    ValueAttribute('line', '', function=get_arrow_coordinates),
+    ValueAttribute('line', '', function=get_arrow_coordinates,
+                   fingerprint=lambda text: (text.xy, getattr(text, 'xyann', None))),
 ]
 
 class AgrFile:
-    head = '@version 50125\n'
-    body = tail = ''
-    indent = 0
-    kwargs = {}
+    """
+    The content of an agr file.
+
+    Header and body are collected as lists of lines. Data sets only keep a reference
+    to their data, which is formatted chunk-wise when the file is written. Hence the
+    memory needed to write a file does not grow with the size of the data.
+    """
+
+    def __init__(self):
+        self.head = ['@version 50125\n']
+        self.body = []
+        self.tail = []
+        self.indent = 0
+        self.kwargs = {}
 
     def writeline(self, text, part='body', **kwargs):
-        self.kwargs = {**self.kwargs, **kwargs}
+        self.kwargs.update(kwargs)
         content = getattr(self, part)
 
-        content += '@' + ' ' * self.indent + escapestr(text.format(**self.kwargs)) + '\n'
-        setattr(self, part, content)
+        content.append('@' + ' ' * self.indent + escapestr(text.format(**self.kwargs)) + '\n')
+
+    def writelines(self, texts, prefix=''):
+        """
+        Write several lines with a common prefix to the body.
 
-    def writedata(self, data):
-        self.tail += '@target {axis}.{line}\n@type xy\n'.format(**self.kwargs)
-        for x, y in data:
-            if np.isfinite([x, y]).all():
-                self.tail += '{} {}\n'.format(x, y)
-        self.tail += '&\n'
+        The prefix is formatted only once and the lines only if they contain braces,
+        the result is the same as calling `writeline(prefix + text)` for each text.
+        """
+        start = '@' + ' ' * self.indent + prefix.format(**self.kwargs)
+        for text in texts:
+            if '{' in text or '}' in text:
+                text = text.format(**self.kwargs)
+            self.body.append((start + text).translate(escape_table) + '\n')
 
-    def save(self, filename):
-        with open(filename, 'w') as file:
-            file.write(self.head)
-            file.write(self.body)
-            file.write(self.tail)
+    def writedata(self, data, precision=None, decimation=None):
+        """
+        Add a data set to the file.
+
+        Args:
+            data: Array with the data, it is only formatted when the file is written.
+            precision (opt.): Number of significant digits, see `format_data`.
+            decimation (opt.): Arguments of `decimate`, to reduce the data when it is written.
+        """
+        self.tail.append(('{axis}.{line}'.format(**self.kwargs), data, precision, decimation))
+
+    def write(self, file, stats=null_stats):
+        """
+        Write the agr file to an open file or buffer.
+
+        Args:
+            file: The open file
+            stats (opt.): ExportStats, to which the times of decimation, formatting and
+                writing are added
+        """
+        with stats.phase('write'):
+            file.writelines(self.head)
+            file.writelines(self.body)
+        if stats is not null_stats:
+            stats.count('bytes', sum(map(len, self.head)) + sum(map(len, self.body)))
+        for target, data, precision, decimation in self.tail:
+            if decimation is not None:
+                with stats.phase('decimate'):
+                    data = decimate(data, **decimation)
+            stats.count('sets')
+            stats.count('points', len(data))
+            header = '@target {}\n@type xy\n'.format(target)
+            with stats.phase('write'):
+                file.write(header)
+            chunks = format_data(data, precision=precision)
+            while True:
+                with stats.phase('format'):
+                    chunk = next(chunks, None)
+                if chunk is None:
+                    break
+                with stats.phase('write'):
+                    file.write(chunk)
+                stats.count('bytes', len(chunk))
+            file.write('&\n')
+            stats.count('bytes', len(header) + 2)
+
+    def save(self, filename, stats=null_stats):
+        with open_agr(filename, 'w') as file:
+            self.write(file, stats=stats)
 
 
 def _process_attributes(attrs, source, agr, prefix=''):
@@ -320,21 +1001,179 @@ def _process_attributes(attrs, source, agr, prefix=''):
         agr.writeline(prefix + attr_dict['fmt'], attr=attr, value=value)
 
 
+class AttributePlan:
+    """
+    An attribute table, which is compiled once per export.
+
+    The lines of static attributes are taken as they are and the value attributes are
+    bound to their format method, such that writing the attributes of an artist does not
+    dispatch on the type of each attribute.
+    """
+
+    def __init__(self, attrs, prefix=''):
+        """
+        Args:
+            attrs: A list of attributes, e.g. `agr_line_attrs`
+            prefix (opt.): The prefix of all lines, which may contain fields of `AgrFile.kwargs`
+        """
+        self.prefix = prefix
+        self.steps = [(attr.fmt, None) if type(attr) is StaticAttribute else (None, attr.format)
+                      for attr in attrs]
+
+    def texts(self, source, **kwargs):
+        for text, format in self.steps:
+            if format is not None:
+                text = format(source, **kwargs)
+                if text is None:
+                    continue
+            yield text
+
+    def write(self, source, agr, stats=null_stats, **kwargs):
+        """
+        Write the attributes of source to an AgrFile.
+        """
+        with stats.phase('attributes'):
+            agr.writelines(self.texts(source, stats=stats, **kwargs), self.prefix)
+
+
 def process_attributes(attrs, source, agr, prefix='', **kwargs):
+    """
+    Write the attributes of source to an AgrFile, see `AttributePlan`.
+
+    Colors are mapped by the ColorRegistry given as keyword `colors`, by default a new one.
+    """
+    kwargs.setdefault('colors', ColorRegistry(ValueAttribute.attr_lists['color']))
+    AttributePlan(attrs, prefix).write(source, agr, **kwargs)
+
+
+hash_version = 2
+
+
+def _update_hash(h, source, attrs):
     for attr in attrs:
-        fmt = attr.format(source, **kwargs)
-        if fmt is not None:
-            agr.writeline(prefix + fmt)
+        if isinstance(attr, ValueAttribute):
+            value = attr.fingerprint(source)
+            if isinstance(value, np.ndarray):
+                value = value.tolist()
+            h.update(repr(value).encode())
 
 
-def export_to_agr(figure, filename, **kwargs):
+def figure_hash(figure, **options):
     """
-    Export a matplotlib figure to xmgrace format.
+    Get a fingerprint of the exportable state of a figure.
+
+    The hash covers the data of the lines and the values of the attribute tables of the
+    export, e.g. `agr_line_attrs`. Values that are only known after a draw, like the position
+    of a legend, are replaced by the state they depend on (see `ValueAttribute.fingerprint`),
+    hence the hash does not need a draw of the figure.
+
+    Args:
+        figure: The matplotlib figure
+        **options: Options of the export, e.g. precision, that are included in the hash
+
+    Returns:
+        The hex digest of the hash
+    """
+    h = hashlib.sha1()
+    h.update(repr((hash_version, sorted(options.items()))).encode())
+    h.update(repr((figure.get_size_inches().tolist(), figure.dpi)).encode())
+    for axis in figure.axes:
+        _update_hash(h, axis, agr_axis_attrs)
+        for line in axis.lines:
+            _update_hash(h, line, agr_line_attrs)
+            data = np.ascontiguousarray(line.get_xydata())
+            h.update(repr((data.shape, data.dtype.str)).encode())
+            h.update(data.data)
+        for text in axis.texts:
+            _update_hash(h, text, agr_text_attrs)
+            if hasattr(text, 'arrow_patch'):
+                _update_hash(h, text, agr_arrow_attrs)
+    return h.hexdigest()
+
+
+def read_agr_hash(filename):
+    """
+    Read the hash of the figure, which was stored in an agr file by `export_to_agr`.
+
+    Returns:
+        The hex digest, or None if the file does not exist or has no hash
+    """
+    try:
+        with open_agr(filename) as f:
+            line = f.readline()
+    except (OSError, EOFError):
+        return None
+    if line.startswith('# tudplot hash: '):
+        return line[16:].strip()
+    return None
+
+
+def figure_colors(figure):
+    """
+    Get the colors of all lines of a figure.
+    """
+    colors = []
+    for axis in figure.axes:
+        for line in axis.lines:
+            colors += [line.get_color(), line.get_markeredgecolor(), line.get_markerfacecolor()]
+    return [c for c in colors if not (isinstance(c, str) and c == 'none')]
+
+
+def write_color_map(agr, colors):
+    """
+    Write the color map of a ColorRegistry to the head of an AgrFile.
+
+    Colors without a name, e.g. RGBA arrays, are named by their hex value.
+    """
+    for i, color, rgba in colors:
+        if isinstance(color, str) and color == 'none':
+            continue
+        rgb_tuple = tuple(int(255 * c) for c in rgba[:3])
+        color_name = tudcolor_names.get(rgba, color if isinstance(color, str) else to_hex(rgba))
+        agr.writeline('map color {index} to {rgb}, "{color}"',
+                      part='head', index=i, rgb=rgb_tuple, color=color_name)
+
+
+def prepare_agr(figure, filename=None, precision=None, palette=None, downsample=None,
+                layout=None, cache=False, stats=null_stats, **kwargs):
+    """
+    Build the AgrFile of a figure, without writing it.
+
+    All attributes are extracted from the figure, but the data sets only keep references
+    to the data arrays of the lines, which are formatted when the file is written. Hence
+    the figure may be changed or closed, once this function returned.
+
+    Args:
+        figure: The matplotlib figure
+        filename (opt.): The agr file, which is checked for an up-to-date hash if cache is True
+        stats (opt.): ExportStats of the export
+        Other arguments are the same as for `export_to_agr`.
+
+    Returns:
+        Tuple of the AgrFile and the hash of the figure, the AgrFile is None if
+        the file is up to date.
     """
-    cc = ColorConverter()
     agr = AgrFile()
-    # agr_attr_lists['color'] = ['white', 'black']
-    # agr_colors =
+    kwargs['stats'] = stats
+    digest = None
+    if cache:
+        with stats.phase('hash'):
+            digest = figure_hash(figure, precision=precision, palette=palette,
+                                 downsample=downsample,
+                                 convert_latex=kwargs.get('convert_latex', True))
+            if (filename is not None and not hasattr(filename, 'write') and
+                    read_agr_hash(filename) == digest):
+                return None, digest
+        agr.head.insert(0, '# tudplot hash: {}\n'.format(digest))
+    with stats.phase('layout'):
+        kwargs['layout'] = layout or Layout(figure)
+    kwargs['colors'] = ColorRegistry(ValueAttribute.attr_lists['color'])
+    if palette is not None:
+        kwargs['colors'].set_palette(palette, figure_colors(figure))
+    axis_plan = AttributePlan(agr_axis_attrs)
+    line_plan = AttributePlan(agr_line_attrs, '{line} ')
+    text_plan = AttributePlan(agr_text_attrs, 'string ')
+    arrow_plan = AttributePlan(agr_arrow_attrs, 'line ')
     papersize = figure.get_size_inches()*120
     agr.writeline('page size {}, {}'.format(*papersize))
     for i, axis in enumerate(figure.axes):
@@ -348,18 +1187,26 @@ def export_to_agr(figure, filename, **kwargs):
         agr.writeline('with {axis}')
         agr.indent = 4
 
-        process_attributes(agr_axis_attrs, axis, agr, **kwargs)
+        axis_plan.write(axis, agr, **kwargs)
 
         for j, line in enumerate(axis.lines):
             agr.kwargs['line'] = 's{}'.format(j)
-            process_attributes(agr_line_attrs, line, agr, '{line} ', **kwargs)
-            agr.writedata(line.get_xydata())
+            line_plan.write(line, agr, **kwargs)
+            data = line.get_xydata()
+            decimation = None
+            if downsample is not None and not has_markers(line):
+                decimation = decimation_params(axis, papersize, downsample)
+            if precision == 'auto':
+                agr.writedata(data, precision=auto_precision(data, axis, papersize),
+                              decimation=decimation)
+            else:
+                agr.writedata(data, precision=precision, decimation=decimation)
 
         for text in axis.texts:
             agr.indent = 0
             agr.writeline('with string')
             agr.indent = 4
-            process_attributes(agr_text_attrs, text, agr, 'string ', **kwargs)
+            text_plan.write(text, agr, **kwargs)
 
             # this is a text of an arrow-annotation
             if hasattr(text, 'arrow_patch'):
@@ -367,77 +1214,901 @@ def export_to_agr(figure, filename, **kwargs):
                 agr.writeline('with line')
                 agr.indent = 4
                 agr.writeline(f'line {agr_axis}')
-                process_attributes(agr_arrow_attrs, text, agr, 'line ', **kwargs)
+                arrow_plan.write(text, agr, **kwargs)
                 agr.indent = 0
                 agr.writeline('line def')
 
 
     agr.indent = 0
-    tudcol_rev = {}
-    for name, color in tudcolors.items():
-        if isinstance(color, str):
-            rgba, = cc.to_rgba_array(color)
-            tudcol_rev[tuple(rgba)] = name           
+    write_color_map(agr, kwargs['colors'])
+
+    return agr, digest
+
+
+def export_to_agr(figure, filename, precision=None, palette=None, downsample=None, layout=None,
+                  profile=None, cache=False, **kwargs):
+    """
+    Export a matplotlib figure to xmgrace format.
+
+    Args:
+        figure: The matplotlib figure
+        filename:
+            Name of the agr file or an open file (or buffer), to which the agr file
+            is written. Data sets are formatted while they are written, such that
+            the data is never held in memory as a whole string.
+        precision (opt.):
+            Number of significant digits of the data values. If this is 'auto', the
+            precision is chosen for each line from the resolution of its axis on the
+            agr page, see `auto_precision`. By default the full precision is written.
+        palette (opt.):
+            Restrict the color map to a palette: 'tud' replaces each color by the nearest
+            TU color, a number N clusters the colors of the figure to N colors and a list
+            of colors is used as is. See `ColorRegistry.set_palette`.
+        downsample (opt.):
+            Reduce the number of points of the lines, such that the plot looks the same
+            at the resolution of the agr page. Either 'minmax' or 'lttb', see `decimate`.
+        layout (opt.):
+            The `Layout` of the figure. By default the layout is computed by a draw
+            of the figure without rendering.
+        profile (opt.):
+            An ExportStats or a callback, to profile the phases of the export.
+            See `ExportStats`.
+        cache (opt.):
+            If True, the hash of the figure (see `figure_hash`) is stored in the agr file,
+            and the export is skipped if the file already holds the same hash.
+
+    Returns:
+        The hash of the figure if cache is True, otherwise None
+    """
+    stats = get_stats(profile)
+    agr, digest = prepare_agr(figure, filename, precision=precision, palette=palette,
+                              downsample=downsample, layout=layout, cache=cache, stats=stats,
+                              **kwargs)
+    if agr is not None:
+        if hasattr(filename, 'write'):
+            agr.write(filename, stats=stats)
+        else:
+            agr.save(filename, stats=stats)
+    stats.finish()
+    return digest
+
+
+class _Properties:
+    """
+    Base class of the records of an `AgrDocument`.
+
+    The properties are exposed through getters like `get_color`, as for matplotlib
+    artists, such that the attribute tables of the export can be used for them.
+    """
+
+    def __init__(self, **props):
+        self.props = props
+
+    def __getattr__(self, name):
+        props = self.__dict__.get('props', {})
+        if name.startswith('get_') and name[4:] in props:
+            value = props[name[4:]]
+            return lambda: value
+        raise AttributeError(name)
+
+
+class AgrSet(_Properties):
+    """
+    A data set of an `AgrGraph`, with the style properties of a matplotlib line.
+    """
+
+    def __init__(self, data, label='', color=None, linestyle='-', linewidth=None, marker='None',
+                 fillstyle=None, markeredgecolor=None, markerfacecolor=None,
+                 markeredgewidth=None):
+        super().__init__(
+            label=label, color=color, linestyle=linestyle,
+            linewidth=linewidth if linewidth is not None else rcParams['lines.linewidth'],
+            marker=marker,
+            fillstyle=fillstyle if fillstyle is not None else rcParams['markers.fillstyle'],
+            markeredgecolor=markeredgecolor if markeredgecolor is not None else color,
+            markerfacecolor=markerfacecolor if markerfacecolor is not None else color,
+            markeredgewidth=(markeredgewidth if markeredgewidth is not None
+                             else rcParams['lines.markeredgewidth']),
+        )
+        self.data = data
+
+    def colors(self):
+        return [self.props[key] for key in ('color', 'markeredgecolor', 'markerfacecolor')
+                if not (isinstance(self.props[key], str) and self.props[key] == 'none')]
+
+
+def _limits(values, scale, margin):
+    values = values[np.isfinite(values)]
+    if 'log' in scale:
+        values = np.log10(values[values > 0])
+    if len(values) == 0:
+        return (1, 10) if 'log' in scale else (0, 1)
+    vmin, vmax = values.min(), values.max()
+    delta = (vmax - vmin) * margin if vmax > vmin else 0.5
+    vmin, vmax = vmin - delta, vmax + delta
+    if 'log' in scale:
+        return 10**vmin, 10**vmax
+    return vmin, vmax
+
+
+class AgrGraph(_Properties):
+    """
+    A graph of an `AgrDocument`, which corresponds to an axis of a matplotlib figure.
+    """
+
+    def __init__(self, document, position=None, xlim=None, ylim=None, xscale='linear',
+                 yscale='linear', title='', xlabel='', ylabel='', legend=False,
+                 legend_position=None):
+        super().__init__(title=title, xlabel=xlabel, ylabel=ylabel, xscale=xscale,
+                         yscale=yscale)
+        self.document = document
+        if position is None:
+            position = (rcParams['figure.subplot.left'], rcParams['figure.subplot.bottom'],
+                        rcParams['figure.subplot.right'], rcParams['figure.subplot.top'])
+        self.position = Bbox.from_extents(*position)
+        self.xlim = xlim
+        self.ylim = ylim
+        self.legend = legend
+        self.legend_position = legend_position
+        self.sets = []
+        self._colors = rcParams['axes.prop_cycle'].by_key().get('color', ['black'])
+
+    def set(self, x, y=None, label=None, color=None, **kwargs):
+        """
+        Add a data set to the graph.
+
+        Args:
+            x: The x values, or a pandas Series if y is None, whose index are the x values
+            y (opt.): The y values
+            label (opt.): The legend label, by default the name of a Series
+            color (opt.): The color, by default the next color of the color cycle
+            **kwargs: Other style properties, see `AgrSet`, e.g. linestyle or marker
+
+        Returns:
+            The graph, such that calls may be chained
+        """
+        if y is None:
+            x, y = x.index, x
+        if label is None:
+            label = getattr(y, 'name', None)
+            label = '' if label is None else str(label)
+        if color is None:
+            color = self._colors[len(self.sets) % len(self._colors)]
+        data = np.column_stack((np.asarray(x, dtype=float), np.asarray(y, dtype=float)))
+        self.sets.append(AgrSet(data, label=label, color=color, **kwargs))
+        return self
+
+    def frame(self, frame, x=None, columns=None, **kwargs):
+        """
+        Add the columns of a DataFrame as data sets, labeled by the column names.
+
+        Args:
+            frame: The DataFrame
+            x (opt.): The column of the x values, by default the index is used
+            columns (opt.): The columns of the y values, by default all other columns
+            **kwargs: Style properties of the sets, see `set`
+
+        Returns:
+            The graph, such that calls may be chained
+        """
+        xvalues = frame.index if x is None else frame[x]
+        if columns is None:
+            columns = [col for col in frame.columns if col != x]
+        for col in columns:
+            self.set(xvalues, frame[col], label=str(col), **kwargs)
+        return self
+
+    def get_position(self):
+        return self.position
+
+    def get_xlim(self):
+        if self.xlim is None:
+            values = np.concatenate([s.data[:, 0] for s in self.sets] or [np.empty(0)])
+            self.xlim = _limits(values, self.props['xscale'], rcParams['axes.xmargin'])
+        return self.xlim
+
+    def get_ylim(self):
+        if self.ylim is None:
+            values = np.concatenate([s.data[:, 1] for s in self.sets] or [np.empty(0)])
+            self.ylim = _limits(values, self.props['yscale'], rcParams['axes.ymargin'])
+        return self.ylim
+
+    def world(self):
+        (xmin, xmax), (ymin, ymax) = self.get_xlim(), self.get_ylim()
+        return '{}, {}, {}, {}'.format(xmin, ymin, xmax, ymax)
+
+    def viewport(self):
+        """
+        Get the viewport coordinates (xmin, ymin, xmax, ymax) of the graph.
+        """
+        fx, fy = self.document.size
+        sx = fx / min(fx, fy)
+        sy = fy / min(fx, fy)
+        box = self.position
+        return np.array([box.xmin*sx, box.ymin*sy, box.xmax*sx, box.ymax*sy])
+
+    def view(self):
+        return '{:.3}, {:.3}, {:.3}, {:.3}'.format(*self.viewport())
+
+    def major_ticks(self, dim):
+        if 'log' in self.props['{}scale'.format(dim)]:
+            return 10.0
+        ticks = MaxNLocator(nbins=6, steps=[1, 2, 2.5, 5, 10]).tick_values(*getattr(self, 'get_{}lim'.format(dim))())
+        return (ticks[1:] - ticks[:-1]).mean()
+
+    def legend_on(self):
+        return 'on' if self.legend else 'off'
+
+    def legend_coords(self):
+        if not self.legend:
+            return '0, 0'
+        if self.legend_position is None:
+            xmin, ymin, xmax, ymax = self.viewport()
+            return '{:.3f}, {:.3f}'.format(xmin + 0.9 * (xmax - xmin), ymin + 0.9 * (ymax - ymin))
+        return '{:.3f}, {:.3f}'.format(*self.legend_position)
+
+
+agr_graph_attrs = [attr for attr in agr_axis_attrs if type(attr) is StaticAttribute][:4] + [
+    ValueAttribute('world', 'world', function=methodcaller('world')),
+    ValueAttribute('view', 'view', function=methodcaller('view')),
+] + [attr for attr in agr_axis_attrs if attr.key in ('title', 'xlabel', 'ylabel', 'xscale', 'yscale')] + [
+    ValueAttribute('xticks', 'xaxis tick major', function=methodcaller('major_ticks', 'x')),
+    ValueAttribute('yticks', 'yaxis tick major', function=methodcaller('major_ticks', 'y')),
+    StaticAttribute('xticklabels', 'xaxis ticklabel on'),
+    StaticAttribute('yticklabels', 'yaxis ticklabel on'),
+    StaticAttribute('xlabelposition', 'xaxis label place normal'),
+    StaticAttribute('xtickposition', 'xaxis ticklabel place normal'),
+    StaticAttribute('ylabelposition', 'yaxis label place normal'),
+    StaticAttribute('ytickposition', 'yaxis ticklabel place normal'),
+    ValueAttribute('legend', 'legend', function=methodcaller('legend_on')),
+    StaticAttribute('legend', 'legend loctype view'),
+    ValueAttribute('legend', 'legend', function=methodcaller('legend_coords')),
+]
+
+
+class AgrDocument:
+    """
+    Build an agr file directly from data, without a matplotlib figure.
+
+    The document is written with the same attribute tables, color map and latex conversion
+    as `export_to_agr`, but no artists are created and no layout is drawn:
+
+        doc = AgrDocument()
+        doc.graph(xlabel='$t$ / s', yscale='log', legend=True).set(t, y, label=r'$\\tau$')
+        doc.save('data.agr')
+
+    Missing styles are taken from the matplotlib rc parameters, e.g. the color cycle
+    that is set by `tudplot.activate`.
+    """
+
+    def __init__(self, size=None, precision=None, palette=None, downsample=None,
+                 convert_latex=True):
+        """
+        Args:
+            size (opt.): Width and height of the page in inches, by default the figure size
+            precision, palette, downsample, convert_latex (opt.): See `export_to_agr`
+        """
+        self.size = tuple(size if size is not None else rcParams['figure.figsize'])
+        self.precision = precision
+        self.palette = palette
+        self.downsample = downsample
+        self.convert_latex = convert_latex
+        self.graphs = []
+
+    def graph(self, position=None, **kwargs):
+        """
+        Add a graph to the document.
+
+        Args:
+            position (opt.):
+                The extents (left, bottom, right, top) of the graph as fractions of the page,
+                by default the position of a single subplot.
+            **kwargs:
+                Properties of the graph: xlim, ylim, xscale, yscale, title, xlabel, ylabel,
+                legend and legend_position (in viewport coordinates).
+
+        Returns:
+            The new AgrGraph
+        """
+        graph = AgrGraph(self, position=position, **kwargs)
+        self.graphs.append(graph)
+        return graph
+
+    def prepare(self, stats=null_stats):
+        """
+        Build the AgrFile of the document.
+        """
+        agr = AgrFile()
+        kwargs = {'stats': stats, 'convert_latex': self.convert_latex}
+        kwargs['colors'] = ColorRegistry(ValueAttribute.attr_lists['color'])
+        if self.palette is not None:
+            colors = [c for graph in self.graphs for s in graph.sets for c in s.colors()]
+            kwargs['colors'].set_palette(self.palette, colors)
+        graph_plan = AttributePlan(agr_graph_attrs)
+        set_plan = AttributePlan(agr_line_attrs, '{line} ')
+        papersize = np.array(self.size)*120
+        agr.writeline('page size {}, {}'.format(*papersize))
+        for i, graph in enumerate(self.graphs):
+            agr.indent = 0
+            agr.writeline('{axis} on', axis='g{}'.format(i))
+            agr.writeline('{axis} hidden false')
+            agr.writeline('{axis} type XY')
+            agr.writeline('{axis} stacked false')
+            agr.writeline('with {axis}')
+            agr.indent = 4
+
+            graph_plan.write(graph, agr, **kwargs)
+
+            decimation = None
+            if self.downsample is not None:
+                decimation = decimation_params(graph, papersize, self.downsample)
+            for j, agr_set in enumerate(graph.sets):
+                agr.kwargs['line'] = 's{}'.format(j)
+                set_plan.write(agr_set, agr, **kwargs)
+                if self.precision == 'auto':
+                    precision = auto_precision(agr_set.data, graph, papersize)
+                else:
+                    precision = self.precision
+                agr.writedata(agr_set.data, precision=precision,
+                              decimation=None if has_markers(agr_set) else decimation)
+
+        agr.indent = 0
+        write_color_map(agr, kwargs['colors'])
+        return agr
+
+    def save(self, filename, profile=None):
+        """
+        Write the document to an agr file.
+
+        Args:
+            filename: Name of the agr file or an open file (or buffer)
+            profile (opt.): An ExportStats or a callback, see `export_to_agr`
+        """
+        stats = get_stats(profile)
+        agr = self.prepare(stats=stats)
+        if hasattr(filename, 'write'):
+            agr.write(filename, stats=stats)
+        else:
+            agr.save(filename, stats=stats)
+        stats.finish()
+
+
+def parse_data_block(text, dtype=float):
+    """
+    Parse the text of a data block into an array of shape (N, M).
+    """
+    # the first non-blank line, without splitting the whole block
+    first_line = re.search(r'\S[^\n]*', text)
+    ncols = len(first_line.group().split()) if first_line else 0
+    if ncols == 0:
+        return np.array([], dtype=dtype)
+    values = np.fromstring(text, dtype=dtype, sep=' ')
+    if len(values) % ncols != 0:
+        # rows of different length, parse them one by one
+        return np.array([[float(d) for d in line.split()]
+                         for line in text.splitlines() if line.strip()])
+    return values.reshape(-1, ncols)
+
+
+class AgrReader:
+    """
+    Read lines and whole data blocks from an agr file.
+
+    The file is read in large chunks. The data blocks are located by searching
+    the terminating '&' in the buffer, the data lines are never split one by one.
+    """
 
-    for i, color in enumerate(ValueAttribute.attr_lists['color']):
-        # print(i, color)
-        if color is not 'none':
-            rgba, = cc.to_rgba_array(color)
-            rgb_tuple = tuple(int(255 * c) for c in rgba[:3])
-            color_name = tudcol_rev.get(tuple(rgba), color)
-            agr.writeline('map color {index} to {rgb}, "{color}"',
-                          part='head', index=i, rgb=rgb_tuple, color=color_name)
+    def __init__(self, file, chunksize=2**22):
+        self.file = file
+        self.chunksize = chunksize
+        self.buffer = ''
+        self.pos = 0
+
+    def _fill(self):
+        chunk = self.file.read(self.chunksize)
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+        return len(chunk) > 0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        line = self.readline()
+        if line == '':
+            raise StopIteration
+        return line
+
+    def readline(self):
+        i = self.buffer.find('\n', self.pos)
+        while i < 0:
+            if not self._fill():
+                line = self.buffer[self.pos:]
+                self.pos = len(self.buffer)
+                return line
+            i = self.buffer.find('\n', self.pos)
+        line = self.buffer[self.pos:i + 1]
+        self.pos = i + 1
+        return line
+
+    def read_block(self, keep=True):
+        """
+        Read the text of a data block, up to the terminating '&'.
+
+        Leading lines of the block that start with '@' (e.g. '@type xy') are skipped.
 
-    agr.save(filename)
+        Args:
+            keep (opt.): If False, the block is skipped and an empty string is returned.
+        """
+        while True:
+            if len(self.buffer) - self.pos < 2 and not self._fill():
+                break
+            if self.buffer.startswith('@', self.pos):
+                self.readline()
+            else:
+                break
+
+        parts = []
+        i = self.buffer.find('&', self.pos)
+        while i < 0:
+            if keep:
+                parts.append(self.buffer[self.pos:])
+            self.pos = len(self.buffer)
+            if not self._fill():
+                return ''.join(parts)
+            i = self.buffer.find('&', self.pos)
+        if keep:
+            parts.append(self.buffer[self.pos:i])
+        self.pos = i
+        # skip the rest of the line with the '&'
+        self.readline()
+        return ''.join(parts)
+
+
+def set_filter(graphs=None, label=None):
+    """
+    Get a function that decides if a data set is selected.
 
+    Args:
+        graphs (opt.): Graph ids of the selected sets, e.g. ['g0', 'g2'] or [0, 2]
+        label (opt.): Regular expression which is searched in the labels of the sets
 
-def load_agr_data(agrfile):
+    Returns:
+        Function with the arguments graph_id and label, or None if all sets are selected
     """
-    Load all named data sets from an agrfile.
+    if graphs is None and label is None:
+        return None
+    if graphs is not None:
+        graphs = {'g{}'.format(g) if isinstance(g, int) else g.lower() for g in graphs}
+    if label is not None:
+        label = re.compile(label)
+
+    def selected(graph_id, set_label):
+        return ((graphs is None or graph_id in graphs) and
+                (label is None or label.search(set_label) is not None))
+    return selected
+
+
+def iter_agr_sets(agrfile, graphs=None, label=None, dtype=float):
     """
+    Iterate over the data sets of an agrfile, which may be compressed.
+
+    The file is read incrementally and only the current data set is held in memory.
+    Sets which have a legend entry but no data are yielded at the end with an empty array.
+
+    Args:
+        agrfile: Name of the agr file
+        graphs (opt.): Only load sets of these graphs, e.g. ['g0', 'g2'] or [0, 2]
+        label (opt.): Only load sets whose label matches this regular expression
+        dtype (opt.): Data type of the arrays, e.g. np.float32
+
+    Yields:
+        Tuple (graph_id, set_id, label, data) for each data set, e.g. ('g0', 's1', 'label', array)
+    """
+    selected = set_filter(graphs, label)
     graphs = OrderedDict()
     cur_graph = None
-    target = None
-    with open(agrfile, 'r', errors='replace') as f:
-        lines = f.readlines()
-    for org_line in lines:
-        line = org_line.lower()
-        if '@with' in line:
-            graph_id = line.split()[1]
-            if graph_id not in graphs:
-                graphs[graph_id] = {}
-            cur_graph = graphs[graph_id]
-        elif 'legend' in line and cur_graph is not None:
-            ma = re.search('([sS]\d+) .+ "(.*)"', org_line)
-            if ma is not None:
-                label = ma.group(2)
-                sid = ma.group(1).lower()
-                if label == '':
-                    gid = [k for k, v in graphs.items() if v is cur_graph][0]
-                    label = '{}.{}'.format(gid, sid)
-                cur_graph[sid] = {'label': label}
-        elif '@target' in line:
-            ma = re.search('(g\d+)\.(s\d+)', line.lower())
-            gid = ma.group(1)
-            sid = ma.group(2)
-            target = []
-            if sid not in graphs[gid]:
-                graphs[gid][sid] = {'label': '{}.{}'.format(gid, sid)}
-            graphs[gid][sid]['data'] = target
-        elif target is not None and '@type' in line:
-            continue
-        elif '&' in line:
-            target = None
-        elif target is not None:
-            target.append([float(d) for d in line.split()])
-
-    data = OrderedDict()
-    for _, graph in graphs.items():
-        for _, set in graph.items():
-            if 'data' in set:
-                data[set['label']] = np.array(set['data'])
+    with open_agr(agrfile) as f:
+        reader = AgrReader(f)
+        for org_line in reader:
+            line = org_line.lower()
+            if '@with' in line:
+                graph_id = line.split()[1]
+                if graph_id not in graphs:
+                    graphs[graph_id] = OrderedDict()
+                cur_graph = graphs[graph_id]
+            elif 'legend' in line and cur_graph is not None:
+                ma = re.search('([sS]\d+) .+ "(.*)"', org_line)
+                if ma is not None:
+                    label = ma.group(2)
+                    sid = ma.group(1).lower()
+                    if label == '':
+                        gid = [k for k, v in graphs.items() if v is cur_graph][0]
+                        label = '{}.{}'.format(gid, sid)
+                    cur_graph[sid] = {'label': label}
+            elif '@target' in line:
+                ma = re.search('(g\d+)\.(s\d+)', line)
+                gid = ma.group(1)
+                sid = ma.group(2)
+                if sid not in graphs[gid]:
+                    graphs[gid][sid] = {'label': '{}.{}'.format(gid, sid)}
+                graphs[gid][sid]['read'] = True
+                label = graphs[gid][sid]['label']
+                if selected is None or selected(gid, label):
+                    yield gid, sid, label, parse_data_block(reader.read_block(), dtype=dtype)
+                else:
+                    reader.read_block(keep=False)
+
+    for gid, graph in graphs.items():
+        for sid, set in graph.items():
+            if 'read' not in set and (selected is None or selected(gid, set['label'])):
+                yield gid, sid, set['label'], np.empty((0,), dtype=dtype)
+
+
+class AgrCache:
+    """
+    On-disk cache for data sets loaded from agr files.
+
+    The sets of an agr file are stored as one .npy file per set, in a directory named
+    by a hash of the path, size and modification time of the agr file. Hence an entry
+    becomes invalid as soon as the agr file changes. Cached arrays are loaded
+    memory-mapped and read-only.
+
+    The total size of the cache is limited, when it is exceeded the least recently
+    used entries are removed.
+    """
+    default_directory = os.path.join(os.path.expanduser('~'), '.cache', 'tudplot')
+
+    def __init__(self, directory=None, max_size=2**30):
+        """
+        Args:
+            directory (opt.): Directory of the cache, default is ~/.cache/tudplot
+            max_size (opt.): Maximal size of the cache in bytes, default is 1 GiB.
+        """
+        self.directory = directory or self.default_directory
+        self.max_size = max_size
+
+    def _entry(self, agrfile):
+        stat = os.stat(agrfile)
+        key = '{}:{}:{}'.format(os.path.abspath(agrfile), stat.st_size, stat.st_mtime_ns)
+        return os.path.join(self.directory, hashlib.sha1(key.encode()).hexdigest())
+
+    def get(self, agrfile):
+        """
+        Get the cached sets of an agr file.
+
+        Returns:
+            List of tuples (graph_id, set_id, label, data) or None if the file is not cached.
+        """
+        entry = self._entry(agrfile)
+        try:
+            with open(os.path.join(entry, 'sets.json'), 'r') as f:
+                sets = json.load(f)
+            data = [np.load(os.path.join(entry, '{}.npy'.format(i)), mmap_mode='r')
+                    for i in range(len(sets))]
+            # mark the entry as recently used
+            os.utime(entry)
+        except (OSError, ValueError):
+            return None
+        return [(gid, sid, label, d) for (gid, sid, label), d in zip(sets, data)]
+
+    def put(self, agrfile, sets):
+        """
+        Store the sets of an agr file, as given by `iter_agr_sets`.
+        """
+        if any(data.dtype == object for *_, data in sets):
+            return
+        entry = self._entry(agrfile)
+        os.makedirs(self.directory, exist_ok=True)
+        tmp = tempfile.mkdtemp(dir=self.directory, prefix='.tmp')
+        try:
+            for i, (*_, data) in enumerate(sets):
+                np.save(os.path.join(tmp, '{}.npy'.format(i)), data)
+            with open(os.path.join(tmp, 'sets.json'), 'w') as f:
+                json.dump([[gid, sid, label] for gid, sid, label, _ in sets], f)
+            os.rename(tmp, entry)
+        except OSError:
+            # the entry was written concurrently or the cache is not writable
+            shutil.rmtree(tmp, ignore_errors=True)
+            return
+        self.evict()
+
+    def evict(self):
+        """
+        Remove the least recently used entries, until the cache fits into its maximal size.
+        """
+        entries = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name.startswith('.') or not os.path.isdir(path):
+                continue
+            size = sum(f.stat().st_size for f in os.scandir(path))
+            entries.append((os.stat(path).st_mtime, size, path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_size:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+
+
+def load_agr_data(agrfile, cache=None, graphs=None, label=None, dtype=float, as_frame=False,
+                  profile=None):
+    """
+    Load all named data sets from an agrfile, which may be compressed.
+
+    Args:
+        agrfile: Name of the agr file
+        cache (opt.):
+            Cache the parsed data on disk, see `AgrCache`. This may be True to use the
+            default cache, a directory or an AgrCache. Cached data is returned as
+            read-only memory-mapped arrays.
+        graphs (opt.): Only load sets of these graphs, e.g. ['g0', 'g2'] or [0, 2]
+        label (opt.): Only load sets whose label matches this regular expression
+        dtype (opt.): Data type of the arrays, e.g. np.float32
+        as_frame (opt.):
+            If True, return a long-format pandas DataFrame with the columns
+            graph, set, label, x, y (and further data columns).
+        profile (opt.):
+            An ExportStats or a callback, to profile the phases cache, parse and frame
+            of the load. See `ExportStats`.
+
+    Returns:
+        OrderedDict of the data arrays, with the set labels as keys, or a DataFrame
+    """
+    stats = get_stats(profile)
+    if cache:
+        if not isinstance(cache, AgrCache):
+            cache = AgrCache(None if cache is True else cache)
+        with stats.phase('cache'):
+            sets = cache.get(agrfile)
+        if sets is None:
+            with stats.phase('parse'):
+                sets = list(iter_agr_sets(agrfile))
+            with stats.phase('cache'):
+                cache.put(agrfile, sets)
+        selected = set_filter(graphs, label)
+        sets = [(gid, sid, lbl, data if data.dtype == dtype else data.astype(dtype))
+                for gid, sid, lbl, data in sets if selected is None or selected(gid, lbl)]
+    else:
+        with stats.phase('parse'):
+            sets = list(iter_agr_sets(agrfile, graphs=graphs, label=label, dtype=dtype))
+    stats.count('bytes', os.path.getsize(agrfile))
+    stats.count('sets', len(sets))
+    stats.count('points', sum(len(s[3]) for s in sets))
+
+    if as_frame:
+        with stats.phase('frame'):
+            frame = _long_frame([s[:3] for s in sets], [s[3] for s in sets],
+                                ['graph', 'set', 'label'])
+        stats.finish()
+        return frame
+    stats.finish()
+    return OrderedDict((lbl, data) for _, _, lbl, data in sets)
+
+
+def _long_frame(keys, arrays, names):
+    """
+    Build a long-format DataFrame of data arrays, by concatenating them.
+
+    Args:
+        keys: One tuple for each array, that identifies the array.
+        arrays: The data arrays of shape (N, M)
+        names: Column names of the entries of the keys
+    """
+    import pandas as pd
+
+    dtypes = [a.dtype for a in arrays if a.size > 0]
+    dtype = np.result_type(*dtypes) if dtypes else float
+    arrays = [a.reshape(len(a), -1) if a.size > 0 else np.empty((0, 0)) for a in arrays]
+    ncols = max([a.shape[1] for a in arrays] + [2])
+    lengths = [len(a) for a in arrays]
+    values = np.full((sum(lengths), ncols), np.nan, dtype=dtype)
+    i = 0
+    for a in arrays:
+        values[i:i + len(a), :a.shape[1]] = a
+        i += len(a)
+
+    columns = OrderedDict()
+    for j, name in enumerate(names):
+        columns[name] = np.repeat(np.array([k[j] for k in keys], dtype=object), lengths)
+    for j, name in enumerate(['x', 'y'] + ['c{}'.format(j) for j in range(2, ncols)]):
+        columns[name] = values[:, j]
+    return pd.DataFrame(columns)
+
+
+def iter_agr_dir(pattern, workers=None, **kwargs):
+    """
+    Load many agr files in parallel and yield the results as they are finished.
+
+    Args:
+        pattern:
+            A glob pattern of the agr files or a directory, in which case all agr
+            files of the directory (also compressed) are loaded.
+        workers (opt.): Number of worker processes, by default the number of CPUs.
+        **kwargs: Keyword arguments that are passed to `load_agr_data`.
+
+    Yields:
+        Tuple (filename, data), where data is the result of load_agr_data or the
+        exception that was raised while loading the file.
+    """
+    if os.path.isdir(pattern):
+        files = []
+        for ext in ['', '.gz', '.bz2', '.xz']:
+            files += glob.glob(os.path.join(pattern, '*.agr' + ext))
+    else:
+        files = glob.glob(pattern)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(load_agr_data, f, **kwargs): f for f in sorted(files)}
+        for future in as_completed(futures):
+            try:
+                yield futures[future], future.result()
+            except Exception as e:
+                yield futures[future], e
+
+
+def load_agr_dir(pattern, workers=None, table=False, **kwargs):
+    """
+    Load many agr files in parallel, see `iter_agr_dir`.
+
+    Files that can not be loaded are skipped with a warning.
+
+    Args:
+        pattern: A glob pattern of the agr files or a directory.
+        workers (opt.): Number of worker processes, by default the number of CPUs.
+        table (opt.):
+            If True, the data is returned as a long-format pandas DataFrame with
+            the columns file, graph, set, label, x, y (and further data columns).
+        **kwargs: Keyword arguments that are passed to `load_agr_data`.
+
+    Returns:
+        OrderedDict of the loaded data for each file, sorted by file name, or a DataFrame.
+    """
+    results = {}
+    for fname, data in iter_agr_dir(pattern, workers=workers, as_frame=table, **kwargs):
+        if isinstance(data, Exception):
+            logging.warning('Could not load {}: {!r}'.format(fname, data))
+        else:
+            results[fname] = data
+    results = OrderedDict(sorted(results.items()))
+    if table:
+        import pandas as pd
+        if not results:
+            return pd.DataFrame(columns=['file', 'graph', 'set', 'label', 'x', 'y'])
+        for fname, frame in results.items():
+            frame.insert(0, 'file', fname)
+        return pd.concat(list(results.values()), ignore_index=True)
+    return results
+
+
+class AgrArchive(Mapping):
+    """
+    Random access to the data sets of a large agr file.
+
+    The file is scanned once for the byte offsets of the data blocks and the legend
+    labels of the sets. The file is memory-mapped and a data set is only parsed when
+    it is requested. Like the result of `load_agr_data`, the archive is a mapping
+    of set labels to data arrays.
+
+    The index is saved next to the file (as ``<agrfile>.idx``) and reused as long as
+    size and modification time of the file do not change.
+
+    Example:
+        with AgrArchive('measurement.agr') as archive:
+            data = archive['T = 300 K']
+            data = archive.get_set('g0', 's12')
+    """
+    index_suffix = '.idx'
+    scan_pattern = re.compile(
+        rb'^@with\s+(g\d+)|^@\s*(s\d+)\s+legend\s+"(.*)"|^@target\s+(g\d+)\.(s\d+)',
+        re.MULTILINE | re.IGNORECASE
+    )
+
+    def __init__(self, agrfile, persist_index=True):
+        """
+        Args:
+            agrfile: Name of the agr file, the file may not be compressed.
+            persist_index (opt.): If the index of the file is saved and reused.
+        """
+        self.agrfile = agrfile
+        self._file = open(agrfile, 'rb')
+        head = self._file.read(6)
+        if any(head.startswith(magic) for magic, _ in compressions.values()):
+            self._file.close()
+            raise ValueError('Compressed agr files can not be memory-mapped: {}'.format(agrfile))
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        stat = os.stat(agrfile)
+        self._stamp = [stat.st_size, stat.st_mtime_ns]
+        self.sets = None
+        if persist_index:
+            self.sets = self._load_index()
+        if self.sets is None:
+            self.sets = self._scan()
+            if persist_index:
+                self._save_index()
+        self._labels = OrderedDict((s['label'], key) for key, s in self.sets.items())
+
+    def _scan(self):
+        mm = self._mmap
+        sets = OrderedDict()
+        graph_id = None
+        pos = 0
+        while True:
+            ma = self.scan_pattern.search(mm, pos)
+            if ma is None:
+                break
+            pos = ma.end()
+            if ma.group(1) is not None:
+                graph_id = ma.group(1).decode().lower()
+            elif ma.group(2) is not None:
+                if graph_id is None:
+                    continue
+                set_id = ma.group(2).decode().lower()
+                label = ma.group(3).decode(errors='replace') or '{}.{}'.format(graph_id, set_id)
+                sets[graph_id, set_id] = {'label': label, 'start': None, 'end': None}
             else:
-                print(_, set)
-                data[set['label']] = np.empty((0,))
+                key = (ma.group(4).decode().lower(), ma.group(5).decode().lower())
+                sets.setdefault(key, {'label': '{}.{}'.format(*key), 'start': None, 'end': None})
+                # skip the rest of the target line and lines like '@type xy'
+                pos = mm.find(b'\n', pos) + 1 or len(mm)
+                while mm[pos:pos + 1] == b'@':
+                    pos = mm.find(b'\n', pos) + 1 or len(mm)
+                end = mm.find(b'&', pos)
+                if end < 0:
+                    end = len(mm)
+                sets[key]['start'] = pos
+                sets[key]['end'] = end
+                pos = end
+        return sets
+
+    def _load_index(self):
+        try:
+            with open(self.agrfile + self.index_suffix, 'r') as f:
+                index = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if index.get('stamp') != self._stamp:
+            return None
+        return OrderedDict(((gid, sid), {'label': label, 'start': start, 'end': end})
+                           for gid, sid, label, start, end in index['sets'])
+
+    def _save_index(self):
+        index = {
+            'stamp': self._stamp,
+            'sets': [[gid, sid, s['label'], s['start'], s['end']]
+                     for (gid, sid), s in self.sets.items()]
+        }
+        try:
+            with open(self.agrfile + self.index_suffix, 'w') as f:
+                json.dump(index, f)
+        except OSError:
+            logging.info('Could not save index of {}'.format(self.agrfile))
+
+    def get_set(self, graph_id, set_id):
+        """
+        Get the data of a set by its graph and set id, e.g. get_set('g0', 's1').
+        """
+        s = self.sets[graph_id.lower(), set_id.lower()]
+        if s['start'] is None:
+            return np.empty((0,))
+        return parse_data_block(self._mmap[s['start']:s['end']].decode(errors='replace'))
+
+    def __getitem__(self, label):
+        return self.get_set(*self._labels[label])
+
+    def __iter__(self):
+        return iter(self._labels)
+
+    def __len__(self):
+        return len(self._labels)
+
+    def close(self):
+        self._mmap.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
 
-    return data
+    def __exit__(self, *args):
+        self.close()